@@ -429,35 +429,37 @@ fi
 # Extract/Put Image/Extra Files In TMPDIR
 if ${BIN_7ZZ} l -ba "${FILEPATH}" | grep -q "system.new.dat" 2>/dev/null || [[ $(find "${TMPDIR}" -type f -name "system.new.dat*" -print | wc -l) -ge 1 ]]; then
 	printf "A-only DAT-Formatted OTA detected.\n"
-	for partition in $PARTITIONS; do
-		${BIN_7ZZ} e -y "${FILEPATH}" ${partition}.new.dat* ${partition}.transfer.list ${partition}.img 2>/dev/null >> ${TMPDIR}/zip.log
-		${BIN_7ZZ} e -y "${FILEPATH}" ${partition}.*.new.dat* ${partition}.*.transfer.list ${partition}.*.img 2>/dev/null >> ${TMPDIR}/zip.log
+	if [[ -f "${FILEPATH}" && $(head -c2 "${FILEPATH}" 2>/dev/null) == "PK" ]]; then
+		# sdat2img streams the transfer lists and new data straight out of the OTA zip,
+		# only plain partition images are still extracted, in a single archive scan
+		imgpatterns=()
+		for partition in $PARTITIONS; do
+			imgpatterns+=("${partition}.img" "${partition}.*.img")
+		done
+		${BIN_7ZZ} e -y "${FILEPATH}" "${imgpatterns[@]}" 2>/dev/null >> ${TMPDIR}/zip.log
 		rename 's/(\w+)\.(\d+)\.(\w+)/$1.$3/' *
-		# For Oplus A-only OTAs, eg OnePlus Nord 2. Regex matches the 8 digits of Oplus NV ID (prop ro.build.oplus_nv_id) to remove them.
-		# hello@world:~/test_regex# rename -n 's/(\w+)\.(\d+)\.(\w+)/$1.$3/' *
-		# rename(my_bigball.00011011.new.dat.br, my_bigball.new.dat.br)
-		# rename(my_bigball.00011011.patch.dat, my_bigball.patch.dat)
-		# rename(my_bigball.00011011.transfer.list, my_bigball.transfer.list)
-		if [[ -f ${partition}.new.dat.1 ]]; then
-			cat ${partition}.new.dat.{0..999} 2>/dev/null >> ${partition}.new.dat
-			rm -rf ${partition}.new.dat.{0..999}
-		fi
-		ls | grep "\.new\.dat" | while read i; do
-			line=$(echo "$i" | cut -d"." -f1)
-			if [[ $(echo "$i" | grep "\.dat\.xz") ]]; then
-				${BIN_7ZZ} e -y "$i" 2>/dev/null >> ${TMPDIR}/zip.log
-				rm -rf "$i"
-			fi
-			if [[ $(echo "$i" | grep "\.dat\.br") ]]; then
-				echo "Converting brotli ${partition} dat to normal"
-				brotli -d "$i"
-				rm -f "$i"
-			fi
-			echo "Extracting ${partition}"
-			uv run -q ${SDAT2IMG} ${line}.transfer.list ${line}.new.dat "${OUTDIR}"/${line}.img > ${TMPDIR}/extract.log
-			rm -rf ${line}.transfer.list ${line}.new.dat
+		uv run -q --with brotli --with zstandard ${SDAT2IMG} --sparse --outdir "${OUTDIR}" --zip "${FILEPATH}" --partitions $PARTITIONS > ${TMPDIR}/extract.log
+		cat ${TMPDIR}/extract.log
+	else
+		for partition in $PARTITIONS; do
+			${BIN_7ZZ} e -y "${FILEPATH}" ${partition}.new.dat* ${partition}.transfer.list ${partition}.img 2>/dev/null >> ${TMPDIR}/zip.log
+			${BIN_7ZZ} e -y "${FILEPATH}" ${partition}.*.new.dat* ${partition}.*.transfer.list ${partition}.*.img 2>/dev/null >> ${TMPDIR}/zip.log
+			rename 's/(\w+)\.(\d+)\.(\w+)/$1.$3/' *
+			# For Oplus A-only OTAs, eg OnePlus Nord 2. Regex matches the 8 digits of Oplus NV ID (prop ro.build.oplus_nv_id) to remove them.
+			# hello@world:~/test_regex# rename -n 's/(\w+)\.(\d+)\.(\w+)/$1.$3/' *
+			# rename(my_bigball.00011011.new.dat.br, my_bigball.new.dat.br)
+			# rename(my_bigball.00011011.patch.dat, my_bigball.patch.dat)
+			# rename(my_bigball.00011011.transfer.list, my_bigball.transfer.list)
 		done
-	done
+		# Split (.new.dat.0..N) and compressed (.br/.xz/.zst) new data is read as one stream by sdat2img,
+		# all partitions are converted in one run through its process pool
+		if ls *.transfer.list >/dev/null 2>&1; then
+			echo "Extracting $(ls *.transfer.list | sed 's/\.transfer\.list$//' | tr '\n' ' ')"
+			uv run -q --with brotli --with zstandard ${SDAT2IMG} --sparse --outdir "${OUTDIR}" --batch *.transfer.list > ${TMPDIR}/extract.log
+			cat ${TMPDIR}/extract.log
+			rm -rf *.transfer.list *.new.dat*
+		fi
+	fi
 elif ${BIN_7ZZ} l -ba "${FILEPATH}" | grep rawprogram || [[ $(find "${TMPDIR}" -type f -name "*rawprogram*" | wc -l) -ge 1 ]]; then
 	echo "QFIL Detected"
 	rawprograms=$(${BIN_7ZZ} l -ba ${FILEPATH} | gawk '{ print $NF }' | grep rawprogram)
@@ -681,16 +683,20 @@ elif ${BIN_7ZZ} l -ba "${FILEPATH}" | grep ".*.rar\|.*.zip\|.*.7z\|.*.tar$" 2>/d
 	rm -rf "${TMPDIR:?}"/"${UNZIP_DIR}"
 elif ${BIN_7ZZ} l -ba "${FILEPATH}" | grep -q "UPDATE.APP" 2>/dev/null || [[ $(find "${TMPDIR}" -type f -name "UPDATE.APP") ]]; then
 	printf "Huawei UPDATE.APP Detected\n"
-	[[ -f "${FILEPATH}" ]] && ${BIN_7ZZ} x "${FILEPATH}" UPDATE.APP 2>/dev/null >> "${TMPDIR}"/zip.log
-	find "${TMPDIR}" -type f -name "UPDATE.APP" -exec mv {} . \;
-	uv run -q "${SPLITUAPP}" -f "UPDATE.APP"
-	find output/ -type f -name "*.img" -exec mv {} . \;	# Partitions Are Extracted In "output" Folder
-	"${SIMG2IMG}" super*.img super.img.raw 2>/dev/null && rm super*.img
-	if [[ -f super.img ]]; then
-		printf "Creating super.img.raw ...\n"
-		"${SIMG2IMG}" super.img super_* super.img.raw 2>/dev/null
-		[[ ! -s super.img.raw && -f super.img ]] && mv super.img super.img.raw
+	if [[ $(find "${TMPDIR}" -type f -name "UPDATE.APP") ]]; then
+		# UPDATE.APP along with its update_sd_*/update_data_* packages, all split in one run
+		find "${TMPDIR}" -type f \( -name "UPDATE.APP" -o -name "update_*.APP" \) -exec mv {} . \;
+		uv run -q "${SPLITUAPP}" -r -f UPDATE.APP $(find . -maxdepth 1 -type f -name "update_*.APP")
+	elif [[ $(head -c2 "${FILEPATH}" 2>/dev/null) == "PK" ]]; then
+		# Read the packages in place (stored) or as a stream (deflated), no copy in TMPDIR
+		uv run -q "${SPLITUAPP}" -r -f "${FILEPATH}" -z UPDATE.APP 'update_*.APP'
+	else
+		# Other archives are decompressed straight into splituapp through a pipe
+		${BIN_7ZZ} x -so "${FILEPATH}" UPDATE.APP 2>> "${TMPDIR}"/zip.log | uv run -q "${SPLITUAPP}" -r -f -
 	fi
+	find output/ -type f -name "*.img" -exec mv {} . \;	# Partitions Are Extracted In "output" Folder
+	# Sparse images come out raw, with the super pieces already merged into super.img
+	[[ -f super.img ]] && mv super.img super.img.raw
 	superimage_extract || exit 1
 elif ${BIN_7ZZ} l -ba "${FILEPATH}" | grep -q "rockchip" 2>/dev/null || [[ $(find "${TMPDIR}" -type f -name "rockchip") ]]; then
 	printf "Rockchip Detected\n"
@@ -761,6 +767,7 @@ cd "${OUTDIR}"/ || exit
 rm -rf "${TMPDIR:?}"/*
 
 # Extract and decompile device-tree blobs
+BOOT_IMAGES=()
 for image in boot vendor_boot vendor_kernel_boot init_boot recovery; do
     if [[ -f "${image}".img ]]; then
         # Create working directories
@@ -811,10 +818,13 @@ for image in boot vendor_boot vendor_kernel_boot init_boot recovery; do
 		[[ -d "${image}"/dtb ]] && echo "dtb: dtb/$(basename $(ls ${image}/dtb/01*.dtb))" >> ${image}/info.txt
 		[[ -d "${image}"/ramdisk ]] && echo "ramdisk: ramdisk/" >> ${image}/info.txt
 		[[ -d "${image}"/recovery_ramdisk ]] && echo "recovery_ramdisk: recovery_ramdisk/" >> ${image}/info.txt
-		uv run ${BOOTIMG_INFO} "${image}.img" >> "${image}"/info.txt
+		BOOT_IMAGES+=("${image}.img")
 	fi
 done
 
+# Header info of all images is parsed in one run, appended to each info.txt
+[[ ${#BOOT_IMAGES[@]} -gt 0 ]] && uv run ${BOOTIMG_INFO} --info-file info.txt "${BOOT_IMAGES[@]}"
+
 # Extract 'boot.img'-related content
 if [[ -f boot.img ]]; then
     # Extract 'ikconfig'
@@ -4,10 +4,19 @@
 Prints boot, recovery or vendor_boot image info.
 """
 
+import json
+import os
+import sys
 from argparse import ArgumentParser
-from struct import unpack
+from contextlib import redirect_stdout
+from struct import error as struct_error, unpack
 
 BOOT_IMAGE_HEADER_V3_PAGESIZE = 4096
+VENDOR_RAMDISK_NAME_SIZE = 32
+VENDOR_RAMDISK_TABLE_ENTRY_BOARD_ID_SIZE = 16
+
+# vendor_ramdisk_table_entry_v4.ramdisk_type
+VENDOR_RAMDISK_TYPES = {0: 'none', 1: 'platform', 2: 'recovery', 3: 'dlkm'}
 
 def get_number_of_pages(image_size, page_size):
     """calculates the number of pages required for the image"""
@@ -66,6 +75,11 @@ class BootImageInfoFormatter:
         else:
             print(f'pagesize: {BOOT_IMAGE_HEADER_V3_PAGESIZE}')
             print(f"cmdline: '{self.cmdline}'")
+        if self.header_version >= 4:
+            print(f'boot_signature_size: {self.boot_signature_size}')
+
+    def to_dict(self):
+        return dict(vars(self))
 
 def parse_boot_image(boot_img):
     info = BootImageInfoFormatter()
@@ -89,6 +103,7 @@ def parse_boot_image(boot_img):
         info.kernel_size = kernel_ramdisk_second_info[0]
         info.ramdisk_size = kernel_ramdisk_second_info[1]
         os_version_patch_level = kernel_ramdisk_second_info[2]
+        info.header_size = kernel_ramdisk_second_info[3]
         info.second_size = 0
         info.page_size = BOOT_IMAGE_HEADER_V3_PAGESIZE
 
@@ -98,15 +113,18 @@ def parse_boot_image(boot_img):
     if info.header_version < 3:
         info.product_name = cstr(unpack('16s', boot_img.read(16))[0].decode())
         info.cmdline = cstr(unpack('512s', boot_img.read(512))[0].decode())
-        boot_img.read(32)  # ignore SHA
+        info.image_id = unpack('32s', boot_img.read(32))[0].hex()
         info.extra_cmdline = cstr(unpack('1024s', boot_img.read(1024))[0].decode())
     else:
         info.cmdline = cstr(unpack('1536s', boot_img.read(1536))[0].decode())
 
     if info.header_version in {1, 2}:
         info.recovery_dtbo_size = unpack('I', boot_img.read(1 * 4))[0]
+        info.recovery_dtbo_offset = unpack('Q', boot_img.read(8))[0]
+        info.header_size = unpack('I', boot_img.read(4))[0]
     else:
         info.recovery_dtbo_size = 0
+        info.recovery_dtbo_offset = 0
 
     if info.header_version == 2:
         info.dtb_size = unpack('I', boot_img.read(4))[0]
@@ -115,6 +133,11 @@ def parse_boot_image(boot_img):
         info.dtb_size = 0
         info.dtb_load_address = 0
 
+    if info.header_version >= 4:
+        info.boot_signature_size = unpack('I', boot_img.read(4))[0]
+    else:
+        info.boot_signature_size = 0
+
     return info
 
 class VendorBootImageInfoFormatter:
@@ -131,6 +154,15 @@ class VendorBootImageInfoFormatter:
         print(f'dtb_offset: {self.dtb_load_address - base:#010x}')
         print(f"vendor_cmdline: '{self.cmdline}'")
         print(f"board: '{self.product_name}'")
+        if self.header_version >= 4:
+            print(f'vendor_ramdisk_table_entry_num: {self.vendor_ramdisk_table_entry_num}')
+            for entry in self.vendor_ramdisk_table:
+                print(f"vendor_ramdisk: '{entry['ramdisk_name']}' type {entry['ramdisk_type']} "
+                      f"offset {entry['ramdisk_offset']:#x} size {entry['ramdisk_size']}")
+            print(f'vendor_bootconfig_size: {self.vendor_bootconfig_size}')
+
+    def to_dict(self):
+        return dict(vars(self))
 
 def parse_vendor_boot_image(boot_img):
     info = VendorBootImageInfoFormatter()
@@ -147,6 +179,39 @@ def parse_vendor_boot_image(boot_img):
     info.dtb_size = unpack('I', boot_img.read(4))[0]
     info.dtb_load_address = unpack('Q', boot_img.read(8))[0]
 
+    if info.header_version >= 4:
+        info.vendor_ramdisk_table_size = unpack('I', boot_img.read(4))[0]
+        info.vendor_ramdisk_table_entry_num = unpack('I', boot_img.read(4))[0]
+        info.vendor_ramdisk_table_entry_size = unpack('I', boot_img.read(4))[0]
+        info.vendor_bootconfig_size = unpack('I', boot_img.read(4))[0]
+
+        # The table follows the header, vendor ramdisk and dtb sections
+        num_pages = (get_number_of_pages(info.header_size, info.page_size) +
+                     get_number_of_pages(info.vendor_ramdisk_size, info.page_size) +
+                     get_number_of_pages(info.dtb_size, info.page_size))
+        table_offset = num_pages * info.page_size
+        info.vendor_ramdisk_table = []
+        for i in range(info.vendor_ramdisk_table_entry_num):
+            boot_img.seek(table_offset + i * info.vendor_ramdisk_table_entry_size)
+            ramdisk_size, ramdisk_offset, ramdisk_type = unpack('3I', boot_img.read(3 * 4))
+            ramdisk_name = cstr(unpack(f'{VENDOR_RAMDISK_NAME_SIZE}s',
+                                       boot_img.read(VENDOR_RAMDISK_NAME_SIZE))[0].decode())
+            board_id = unpack(f'{VENDOR_RAMDISK_TABLE_ENTRY_BOARD_ID_SIZE}I',
+                              boot_img.read(VENDOR_RAMDISK_TABLE_ENTRY_BOARD_ID_SIZE * 4))
+            info.vendor_ramdisk_table.append({
+                'ramdisk_size': ramdisk_size,
+                'ramdisk_offset': ramdisk_offset,
+                'ramdisk_type': VENDOR_RAMDISK_TYPES.get(ramdisk_type, ramdisk_type),
+                'ramdisk_name': ramdisk_name,
+                'board_id': list(board_id),
+            })
+    else:
+        info.vendor_ramdisk_table_size = 0
+        info.vendor_ramdisk_table_entry_num = 0
+        info.vendor_ramdisk_table_entry_size = 0
+        info.vendor_bootconfig_size = 0
+        info.vendor_ramdisk_table = []
+
     return info
 
 def parse_bootimg_info(boot_img):
@@ -162,17 +227,59 @@ def parse_bootimg_info(boot_img):
             raise ValueError(f'Not an Android boot image, magic: {boot_magic}')
     return info
 
+def parse_bootimg_infos(boot_imgs):
+    """Parses each of |boot_imgs|, returns a list of (path, info, error)
+    where exactly one of info and error is set."""
+    results = []
+    for boot_img in boot_imgs:
+        try:
+            results.append((boot_img, parse_bootimg_info(boot_img), None))
+        except (OSError, ValueError, UnicodeDecodeError, struct_error) as e:
+            results.append((boot_img, None, str(e)))
+    return results
+
 def parse_cmdline():
     """parse command line arguments"""
     parser = ArgumentParser(description='Prints boot, recovery or vendor_boot image info.')
-    parser.add_argument('boot_img', help='path to the boot, recovery or vendor_boot image')
+    parser.add_argument('boot_img', nargs='+', help='path to the boot, recovery or vendor_boot image(s)')
+    parser.add_argument('--json', action='store_true', help='print the info of all images as JSON')
+    parser.add_argument('--info-file', metavar='NAME',
+                        help='append the info of each IMAGE.img to IMAGE/NAME instead of printing it')
     return parser.parse_args()
 
 def main():
     """parse arguments and print boot image info"""
     args = parse_cmdline()
-    info = parse_bootimg_info(args.boot_img)
-    info.print_info()
+    results = parse_bootimg_infos(args.boot_img)
+
+    if args.json:
+        images = []
+        for boot_img, info, error in results:
+            image = {'path': boot_img}
+            image.update(info.to_dict() if info else {'error': error})
+            images.append(image)
+        json.dump(images, sys.stdout, indent=2)
+        print()
+        return 1 if any(error for _, _, error in results) else 0
+
+    failed = 0
+    for boot_img, info, error in results:
+        if not error and args.info_file:
+            info_file = os.path.join(os.path.splitext(boot_img)[0], args.info_file)
+            try:
+                with open(info_file, 'a') as f, redirect_stdout(f):
+                    info.print_info()
+            except OSError as e:
+                error = str(e)
+        elif not error:
+            if len(results) > 1:
+                print(f'==> {boot_img} <==')
+            info.print_info()
+        if error:
+            print(f'{boot_img}: {error}', file=sys.stderr)
+            failed += 1
+
+    return 1 if failed else 0
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -9,137 +9,2041 @@
 from __future__ import absolute_import
 from __future__ import print_function
 
-import sys, os, errno
+import sys, os, io, errno, glob, re, struct, bisect, hashlib, zlib, bz2, time, threading, json, zipfile
+from array import array
+from itertools import islice
 
-def main(TRANSFER_LIST_FILE, NEW_DATA_FILE, OUTPUT_IMAGE_FILE):
-    __version__ = '1.2'
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-    if sys.hexversion < 0x02070000:
-        print >> sys.stderr, "Python 2.7 or newer is required."
+BLOCK_SIZE = 4096
+
+# Size of the reusable buffer used when the kernel can't copy for us
+COPY_BUFFER_SIZE = 1024 * 1024 * 8
+
+class Sdat2ImgError(Exception):
+    """Raised when a transfer list or the data it refers to is invalid."""
+
+class RangeSet(object):
+    """Block ranges of one command, kept flat in an array('Q') as
+    begin0, end0, begin1, end1, ... Iterating yields (begin, end) pairs."""
+    __slots__ = ('data',)
+
+    def __init__(self, data=None):
+        self.data = data if data is not None else array('Q')
+
+    def __len__(self):
+        return len(self.data) // 2
+
+    def __iter__(self):
+        it = iter(self.data)
+        return zip(it, it)
+
+    def __getitem__(self, index):
+        return self.data[2*index], self.data[2*index + 1]
+
+    @property
+    def end(self):
+        if not self.data:
+            return 0
+        if numpy is not None:
+            return int(range_pairs(self.data)[:, 1].max())
+        return max(islice(self.data, 1, None, 2))
+
+def range_pairs(data):
+    """NumPy (N, 2) view of a flat begin, end, ... array('Q'), no copy."""
+    return numpy.frombuffer(data, dtype=numpy.uint64).reshape(-1, 2)
+
+def as_rangeset(ranges):
+    if isinstance(ranges, RangeSet):
+        return ranges
+    return RangeSet(array('Q', [value for pair in ranges for value in pair]))
+
+def rangeset(src):
+    try:
+        num_set = array('Q', map(int, src.split(',')))
+    except (ValueError, OverflowError):
+        num_set = array('Q')
+    if not num_set or len(num_set) != num_set[0]+1 or num_set[0] % 2:
+        raise Sdat2ImgError('Error on parsing following data to rangeset:\n{}'.format(src))
+
+    del num_set[0]
+    return RangeSet(num_set)
+
+def merge_ranges(ranges):
+    """Coalesce consecutive (begin, end) block ranges that touch each other.
+
+    Consecutive 'new' ranges are read back to back from the new data file,
+    so ranges which are also adjacent in the output image can be copied
+    as a single extent. Returns a RangeSet, merged on the flat array
+    (vectorized with NumPy when it is installed).
+    """
+    data = as_rangeset(ranges).data
+    if numpy is not None and data:
+        pairs = range_pairs(data)
+        split = pairs[1:, 0] != pairs[:-1, 1]
+        merged = numpy.empty((int(split.sum()) + 1, 2), dtype=numpy.uint64)
+        merged[:, 0] = pairs[numpy.concatenate(([True], split)), 0]
+        merged[:, 1] = pairs[numpy.concatenate((split, [True])), 1]
+        return RangeSet(array('Q', merged.tobytes()))
+    merged = array('Q')
+    for begin, end in zip(islice(data, 0, None, 2), islice(data, 1, None, 2)):
+        if merged and merged[-1] == begin:
+            merged[-1] = end
+        else:
+            merged.append(begin)
+            merged.append(end)
+    return RangeSet(merged)
+
+def sort_ranges(ranges):
+    """|ranges| as a RangeSet ordered by their first block."""
+    data = as_rangeset(ranges).data
+    if numpy is not None:
+        pairs = range_pairs(data)
+        return RangeSet(array('Q', pairs[numpy.argsort(pairs[:, 0], kind='stable')].tobytes()))
+    return as_rangeset(sorted(as_rangeset(ranges)))
+
+# Magic numbers of the compressed new data formats which carry one
+XZ_MAGIC = b'\xfd7zXZ\x00'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+# Amount of compressed input fed to a decompressor per step
+DECOMPRESS_CHUNK_SIZE = 1024 * 64
+
+def read_fully(reader, view):
+    """readinto() |view| until it is full or the data ends, returns the
+    bytes read. Decompressors return short reads, zero block detection
+    needs whole blocks."""
+    got = 0
+    while got < len(view):
+        n = reader.readinto(view[got:])
+        if not n:
+            break
+        got += n
+    return got
+
+class StreamReader(object):
+    """Base for the new data readers, provides read() on top of readinto()."""
+    def seekable(self):
+        return False
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            chunks = []
+            while True:
+                chunk = self.read(COPY_BUFFER_SIZE)
+                if not chunk:
+                    return b''.join(chunks)
+                chunks.append(chunk)
+        buf = bytearray(size)
+        got = 0
+        with memoryview(buf) as view:
+            while got < size:
+                n = self.readinto(view[got:])
+                if not n:
+                    break
+                got += n
+        del buf[got:]
+        return bytes(buf)
+
+class DecompressReader(StreamReader):
+    """Forward-only file-like object which inflates a compressed new data
+    stream on the fly. Supports brotli ('br'), xz ('xz') and zstd ('zst');
+    brotli and zstd need the 'brotli' and 'zstandard' modules. Truncated
+    or corrupt input raises Sdat2ImgError.
+    """
+    def __init__(self, fileobj, codec):
+        self.fileobj = fileobj
+        self.codec = codec
+        self.pending = memoryview(b'')
+        self.offset = 0
+        self.eof = False
+        self.decompressor = None
+        self.reader = None
+        if codec == 'zst':
+            import zstandard
+            self.reader = zstandard.ZstdDecompressor().stream_reader(fileobj, read_across_frames=True)
+            self.errors = zstandard.ZstdError
+        elif codec == 'br':
+            import brotli
+            self.decompressor = brotli.Decompressor()
+            self.errors = brotli.error
+        elif codec == 'xz':
+            import lzma
+            self.decompressor = lzma.LZMADecompressor()
+            self.errors = lzma.LZMAError
+        else:
+            raise Sdat2ImgError('Unsupported new data compression "{}"'.format(codec))
+
+    def tell(self):
+        return self.offset
+
+    def close(self):
+        if self.reader is not None:
+            self.reader.close()
+        self.fileobj.close()
+
+    def _fill(self, size):
+        """Decompress until some output is pending or the input ends."""
+        while not self.pending and not self.eof:
+            if self.codec == 'xz':
+                if self.decompressor.eof:
+                    # Another stream may follow the one just finished
+                    data = self.decompressor.unused_data or self.fileobj.read(DECOMPRESS_CHUNK_SIZE)
+                    if not data:
+                        self.eof = True
+                        break
+                    import lzma
+                    self.decompressor = lzma.LZMADecompressor()
+                elif self.decompressor.needs_input:
+                    data = self.fileobj.read(DECOMPRESS_CHUNK_SIZE)
+                    if not data:
+                        raise Sdat2ImgError('Compressed new data ended before the end of stream')
+                else:
+                    data = b''
+                self.pending = memoryview(self.decompressor.decompress(data, max(size, COPY_BUFFER_SIZE)))
+            else:
+                data = self.fileobj.read(DECOMPRESS_CHUNK_SIZE)
+                if not data:
+                    if not self.decompressor.is_finished():
+                        raise Sdat2ImgError('Compressed new data ended before the end of stream')
+                    self.eof = True
+                    break
+                self.pending = memoryview(self.decompressor.process(data))
+
+    def readinto(self, b):
+        view = memoryview(b).cast('B')
         try:
-            input = raw_input
-        except NameError: pass
-        input('Press ENTER to exit...')
-        sys.exit(1)
+            if self.reader is not None:
+                n = self.reader.readinto(view)
+            else:
+                self._fill(len(view))
+                n = min(len(view), len(self.pending))
+                view[:n] = self.pending[:n]
+                self.pending = self.pending[n:]
+        except self.errors as e:
+            raise Sdat2ImgError('Corrupt {} new data at offset {}: {}'.format(self.codec, self.offset, e))
+        self.offset += n
+        return n
+
+def new_data_codec(path, head):
+    """Guess the compression of a new data file from its magic or name."""
+    if head.startswith(XZ_MAGIC) or path.endswith('.xz'):
+        return 'xz'
+    if head.startswith(ZSTD_MAGIC) or path.endswith('.zst'):
+        return 'zst'
+    # Brotli streams carry no magic number
+    if path.endswith('.br'):
+        return 'br'
+    return None
+
+class ConcatReader(StreamReader):
+    """Reads an ordered list of new data parts as one logical stream.
+
+    Without an |opener| the parts are plain files and the reader is
+    seekable; extent() then lets RangeCopier copy straight from a part.
+    With an |opener| (e.g. one that decompresses) it is forward-only.
+    """
+    def __init__(self, paths, opener=None):
+        self.paths = list(paths)
+        self.opener = opener
+        self.index = 0
+        self.current = None
+        self.offset = 0
+        self.starts = None
+        if opener is None:
+            self.starts = [0]
+            for path in self.paths:
+                self.starts.append(self.starts[-1] + os.path.getsize(path))
+
+    def seekable(self):
+        return self.opener is None
+
+    def tell(self):
+        return self.offset
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.offset
+        elif whence == os.SEEK_END:
+            offset += self.starts[-1]
+        self.offset = offset
+        self._select(offset)
+        return offset
+
+    def _select(self, offset):
+        """Make the part holding |offset| current and position it."""
+        index = 0
+        while index < len(self.paths) - 1 and self.starts[index + 1] <= offset:
+            index += 1
+        self._open(index)
+        self.current.seek(offset - self.starts[index])
+
+    def _open(self, index):
+        if self.current is not None and self.index == index:
+            return
+        if self.current is not None:
+            self.current.close()
+        self.index = index
+        if index >= len(self.paths):
+            self.current = None
+        elif self.opener is None:
+            self.current = open(self.paths[index], 'rb')
+        else:
+            self.current = self.opener(self.paths[index])
+
+    def extent(self, offset):
+        """Returns (fileobj, part offset, bytes left in part) for |offset|."""
+        self._select(offset)
+        return self.current, offset - self.starts[self.index], self.starts[self.index + 1] - offset
+
+    def readinto(self, b):
+        view = memoryview(b).cast('B')
+        if self.current is None and self.index == 0:
+            self._open(0)
+        while self.current is not None:
+            n = self.current.readinto(view)
+            if n:
+                self.offset += n
+                return n
+            self._open(self.index + 1)
+        return 0
+
+    def close(self):
+        if self.current is not None:
+            self.current.close()
+            self.current = None
+
+# Number of a new data part, before the codec suffix of parts compressed
+# one by one (system.new.dat.2, system.new.dat.2.br)
+PART_NUMBER_RE = re.compile(r'\.(\d+)(?:\.(?:br|xz|zst))?$')
+
+def part_number(path):
+    """Sort key placing system.new.dat.2 before system.new.dat.10."""
+    match = PART_NUMBER_RE.search(path)
+    return (int(match.group(1)) if match else -1, path)
+
+def resolve_new_data_parts(spec):
+    """Expand a new data argument into the ordered list of its parts.
+
+    |spec| may be a list of paths, a glob, a single file, or the name of a
+    payload that was split into <name>.0 .. <name>.N.
+    """
+    if isinstance(spec, (list, tuple)):
+        return list(spec)
+    if os.path.exists(spec):
+        return [spec]
+    if glob.has_magic(spec):
+        parts = glob.glob(spec)
     else:
-        print('sdat2img binary - version: {}\n'.format(__version__))
+        parts = [path for path in glob.glob(glob.escape(spec) + '.*') if PART_NUMBER_RE.search(path)]
+    if not parts:
+        raise IOError(errno.ENOENT, 'No new data found', spec)
+    return sorted(parts, key=part_number)
+
+def open_compressed(path, codec):
+    return DecompressReader(open(path, 'rb'), codec)
+
+def open_new_data(spec):
+    """Open the new data, transparently joining and decompressing parts.
+
+    Parts named like system.new.dat.br.0 hold one compressed stream split
+    in pieces, parts named like system.new.dat.0.br are compressed one by
+    one. A ZipNewData spec is read straight out of its OTA zip.
+    """
+    if isinstance(spec, ZipNewData):
+        return spec.open()
+    parts = resolve_new_data_parts(spec)
+    with open(parts[0], 'rb') as first:
+        head = first.read(len(XZ_MAGIC))
+    if len(parts) == 1:
+        codec = new_data_codec(parts[0], head)
+        if codec is None:
+            return open(parts[0], 'rb')
+        return open_compressed(parts[0], codec)
+
+    codec = new_data_codec(parts[0], b'')
+    if codec is not None:
+        return ConcatReader(parts, lambda path: open_compressed(path, codec))
+    codec = new_data_codec(re.sub(r'\.\d+$', '', parts[0]), head)
+    if codec is not None:
+        return DecompressReader(ConcatReader(parts), codec)
+    return ConcatReader(parts)
+
+# Local file header preceding every member's data in a zip archive
+ZIP_LOCAL_HEADER = struct.Struct('<4s5H3I2H')
+ZIP_LOCAL_HEADER_MAGIC = b'PK\x03\x04'
+
+def zip_member_offset(zip_path, info):
+    """Offset of the data of the member |info| in the zip at |zip_path|."""
+    with open(zip_path, 'rb') as f:
+        f.seek(info.header_offset)
+        fields = ZIP_LOCAL_HEADER.unpack(f.read(ZIP_LOCAL_HEADER.size))
+    if fields[0] != ZIP_LOCAL_HEADER_MAGIC:
+        raise Sdat2ImgError('Bad local header for {} in {}'.format(info.filename, zip_path))
+    return info.header_offset + ZIP_LOCAL_HEADER.size + fields[-2] + fields[-1]
+
+class ZipMemberFile(StreamReader):
+    """Seekable reader of a stored (uncompressed) zip member, served
+    straight from the archive file. extent() lets RangeCopier use kernel
+    copies from it just like from a plain new data file.
+    """
+    def __init__(self, zip_path, info):
+        self.start = zip_member_offset(zip_path, info)
+        self.file = open(zip_path, 'rb')
+        self.size = info.file_size
+        self.offset = 0
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.offset
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.offset
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self.offset = offset
+        return offset
+
+    def extent(self, offset):
+        """Returns (fileobj, archive offset, bytes left in member) for |offset|."""
+        return self.file, self.start + offset, self.size - offset
 
-    def rangeset(src):
-        src_set = src.split(',')
-        num_set =  [int(item) for item in src_set]
-        if len(num_set) != num_set[0]+1:
-            print('Error on parsing following data to rangeset:\n{}'.format(src), file=sys.stderr)
-            sys.exit(1)
+    def readinto(self, b):
+        view = memoryview(b).cast('B')
+        n = min(len(view), self.size - self.offset)
+        if n <= 0:
+            return 0
+        self.file.seek(self.start + self.offset)
+        n = self.file.readinto(view[:n])
+        self.offset += n
+        return n
 
-        return tuple ([ (num_set[i], num_set[i+1]) for i in range(1, len(num_set), 2) ])
+    def close(self):
+        self.file.close()
+
+def open_zip_member(zip_path, info):
+    """Open a member of an OTA zip for streaming, deflated or stored."""
+    if info.compress_type == zipfile.ZIP_STORED:
+        return ZipMemberFile(zip_path, info)
+    with zipfile.ZipFile(zip_path) as archive:
+        # The member keeps the archive file open after the ZipFile is closed
+        return archive.open(info)
+
+class ZipNewData(object):
+    """New data spec naming the |members| (parts) inside the OTA zip at
+    |zip_path|. Unlike an open reader it can be sent to worker processes.
+    """
+    def __init__(self, zip_path, members):
+        self.zip_path = zip_path
+        self.members = list(members)
+
+    def open(self):
+        """Open the members as one stream, like open_new_data() does for files."""
+        with zipfile.ZipFile(self.zip_path) as archive:
+            infos = [archive.getinfo(member) for member in self.members]
+        opener = lambda info: open_zip_member(self.zip_path, info)
+        first = opener(infos[0])
+        try:
+            head = first.read(len(XZ_MAGIC))
+        finally:
+            first.close()
+        if len(infos) == 1:
+            codec = new_data_codec(infos[0].filename, head)
+            if codec is None:
+                return opener(infos[0])
+            return DecompressReader(opener(infos[0]), codec)
+
+        codec = new_data_codec(infos[0].filename, b'')
+        if codec is not None:
+            return ConcatReader(infos, lambda info: DecompressReader(opener(info), codec))
+        codec = new_data_codec(re.sub(r'\.\d+$', '', infos[0].filename), head)
+        if codec is not None:
+            return DecompressReader(ConcatReader(infos, opener), codec)
+        return ConcatReader(infos, opener)
+
+ZERO_BLOCK = bytes(BLOCK_SIZE)
+
+def has_fileno(f):
+    """Whether |f| is backed by a real file descriptor."""
+    try:
+        f.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        return False
+    return True
+
+class RangeCopier(object):
+    """Copies extents from the new data file into the output image.
+
+    Uses os.copy_file_range() or os.sendfile() where the kernel supports
+    them and falls back to readinto() through one preallocated buffer.
+    Non-seekable sources such as a DecompressReader are read strictly in
+    order through the buffer.
+
+    With |sparse| set the data always goes through the buffer and blocks
+    which are all zeros are seeked over instead of written, leaving holes
+    in the (freshly truncated) output image.
+    """
+    def __init__(self, src, dst, buffer_size=COPY_BUFFER_SIZE, sparse=False):
+        self.src = src
+        self.dst = dst
+        self.src_offset = src.tell()
+        self.src_seekable = src.seekable()
+        self.buffer = None
+        self.buffer_size = buffer_size
+        self.sparse = sparse
+        self.skipped = 0
+        self.methods = []
+        if self.src_seekable and not sparse and has_fileno(dst) and (hasattr(src, 'extent') or has_fileno(src)):
+            self.methods = [name for name in ('copy_file_range', 'sendfile') if hasattr(os, name)]
+        self.dst.flush()
+
+    def copy(self, dst_offset, length):
+        """Copy |length| bytes to |dst_offset|, returns the bytes copied."""
+        copied = 0
+        while copied < length and self.methods:
+            try:
+                n = self._kernel_copy(dst_offset + copied, length - copied)
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                                   errno.EOPNOTSUPP, errno.EBADF, errno.ENOTSUP):
+                    raise
+                # Not supported for this pair of files, try the next method
+                self.methods.pop(0)
+                continue
+            if n == 0:
+                return copied
+            copied += n
+            self.src_offset += n
+        if copied < length:
+            copied += self._buffered_copy(dst_offset + copied, length - copied)
+        return copied
+
+    def _kernel_copy(self, dst_offset, length):
+        if hasattr(self.src, 'extent'):
+            part, src_offset, available = self.src.extent(self.src_offset)
+            src_fd = part.fileno()
+            length = min(length, available)
+            if length <= 0:
+                return 0
+        else:
+            src_fd = self.src.fileno()
+            src_offset = self.src_offset
+        dst_fd = self.dst.fileno()
+        if self.methods[0] == 'copy_file_range':
+            return os.copy_file_range(src_fd, dst_fd, length, src_offset, dst_offset)
+        os.lseek(dst_fd, dst_offset, os.SEEK_SET)
+        return os.sendfile(dst_fd, src_fd, src_offset, length)
+
+    def _buffered_copy(self, dst_offset, length):
+        if self.buffer is None:
+            self.buffer = bytearray(self.buffer_size)
+        view = memoryview(self.buffer)
+        if self.src_seekable:
+            self.src.seek(self.src_offset)
+        self.dst.seek(dst_offset)
+        copied = 0
+        while copied < length:
+            n = read_fully(self.src, view[:min(length - copied, self.buffer_size)])
+            if not n:
+                break
+            if self.sparse:
+                self._write_sparse(dst_offset + copied, view, n)
+            else:
+                self.dst.write(view[:n])
+            copied += n
+        self.dst.flush()
+        self.src_offset += copied
+        return copied
+
+    def _write_sparse(self, dst_offset, view, n):
+        """Write the first |n| buffered bytes, skipping all-zero blocks."""
+        written = 0
+        for begin, end in data_runs(self.buffer, n):
+            self.dst.seek(dst_offset + begin)
+            self.dst.write(view[begin:end])
+            written += end - begin
+        self.skipped += n - written
+
+def data_runs(buf, n):
+    """Yield (begin, end) of the runs in buf[:n] which are not all-zero blocks."""
+    run_start = 0
+    pos = 0
+    while pos < n:
+        if buf.startswith(ZERO_BLOCK, pos, n):
+            if run_start < pos:
+                yield run_start, pos
+            pos += BLOCK_SIZE
+            run_start = pos
+        else:
+            pos += BLOCK_SIZE
+    if run_start < n:
+        yield run_start, n
+
+# Largest piece of a range handed to one worker thread
+PARALLEL_EXTENT_SIZE = 1024 * 1024 * 64
+
+def new_data_offsets(ranges):
+    """Prefix sums of the range lengths, i.e. where every range starts in
+    the (uncompressed) new data. The last entry is the total size."""
+    offsets = array('Q', [0])
+    if numpy is not None:
+        pairs = range_pairs(as_rangeset(ranges).data)
+        offsets.frombytes(numpy.cumsum((pairs[:, 1] - pairs[:, 0])*BLOCK_SIZE, dtype=numpy.uint64).tobytes())
+        return offsets
+    total = 0
+    for begin, end in ranges:
+        total += (end - begin)*BLOCK_SIZE
+        offsets.append(total)
+    return offsets
+
+class ParallelRangeWriter(object):
+    """Copies ranges of an uncompressed new data file concurrently.
+
+    Since the input offset of every range is known up front from
+    new_data_offsets(), ranges are independent and are split across
+    |threads| workers which use os.copy_file_range() or os.pread() and
+    os.pwrite() with explicit offsets.
+    """
+    def __init__(self, src, dst, threads, sparse=False):
+        if hasattr(src, 'paths'):
+            self.paths = src.paths
+            self.starts = src.starts
+        else:
+            self.paths = [src.name]
+            self.starts = [0, os.fstat(src.fileno()).st_size]
+        self.base = src.tell()
+        self.dst_fd = dst.fileno()
+        self.threads = threads
+        self.sparse = sparse
+        self.skipped = 0
+        self.kernel_copy = hasattr(os, 'copy_file_range') and not sparse
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        dst.flush()
+
+    @staticmethod
+    def supported(src, dst):
+        """Whether |src| is uncompressed data in files we can pread() from."""
+        if not (hasattr(os, 'pread') and src.seekable() and has_fileno(dst)):
+            return False
+        return isinstance(src, ConcatReader) or (has_fileno(src) and hasattr(src, 'name'))
+
+    def _copy(self, fds, src_offset, dst_offset, length):
+        copied = 0
+        while copied < length:
+            index = bisect.bisect_right(self.starts, src_offset + copied) - 1
+            if index >= len(fds):
+                break
+            part_offset = src_offset + copied - self.starts[index]
+            want = min(length - copied, self.starts[index + 1] - src_offset - copied)
+            n = 0
+            if self.kernel_copy:
+                try:
+                    n = os.copy_file_range(fds[index], self.dst_fd, want, part_offset, dst_offset + copied)
+                except OSError as e:
+                    if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                        raise
+                    self.kernel_copy = False
+            if not n:
+                n = self._buffered(fds[index], part_offset, dst_offset + copied, want)
+            if not n:
+                break
+            copied += n
+        return copied
+
+    def _buffered(self, fd, src_offset, dst_offset, length):
+        buf = getattr(self.local, 'buffer', None)
+        if buf is None:
+            buf = self.local.buffer = bytearray(COPY_BUFFER_SIZE)
+        view = memoryview(buf)
+        length = min(length, COPY_BUFFER_SIZE)
+        if hasattr(os, 'preadv'):
+            n = os.preadv(fd, [view[:length]], src_offset)
+        else:
+            data = os.pread(fd, length, src_offset)
+            n = len(data)
+            view[:n] = data
+        runs = data_runs(buf, n) if self.sparse else [(0, n)]
+        written = 0
+        for begin, end in runs:
+            pos = begin
+            while pos < end:
+                pos += os.pwrite(self.dst_fd, view[pos:end], dst_offset + pos)
+            written += end - begin
+        if written < n:
+            with self.lock:
+                self.skipped += n - written
+        return n
+
+    def write(self, extents):
+        """Copy (src_offset, dst_offset, length) |extents|, returns bytes copied."""
+        from concurrent.futures import ThreadPoolExecutor
+
+        tasks = []
+        for src_offset, dst_offset, length in extents:
+            for pos in range(0, length, PARALLEL_EXTENT_SIZE):
+                tasks.append((self.base + src_offset + pos, dst_offset + pos, min(PARALLEL_EXTENT_SIZE, length - pos)))
+
+        fds = [os.open(path, os.O_RDONLY) for path in self.paths]
+        try:
+            with ThreadPoolExecutor(max_workers=self.threads) as pool:
+                results = pool.map(lambda task: (self._copy(fds, *task), task[2]), tasks)
+                copied = 0
+                for n, length in results:
+                    if n < length:
+                        raise Sdat2ImgError('New data ended {} bytes early'.format(length - n))
+                    copied += n
+        finally:
+            for fd in fds:
+                os.close(fd)
+        return copied
+
+# Android sparse image format, see system/core/libsparse/sparse_format.h
+SPARSE_HEADER_MAGIC = 0xED26FF3A
+SPARSE_HEADER = struct.Struct('<I4H4I')
+CHUNK_HEADER = struct.Struct('<2H2I')
+CHUNK_TYPE_RAW = 0xCAC1
+CHUNK_TYPE_FILL = 0xCAC2
+CHUNK_TYPE_DONT_CARE = 0xCAC3
+CHUNK_TYPE_CRC32 = 0xCAC4
+
+# Largest RAW chunk whose total size still fits the 32-bit chunk header
+MAX_RAW_CHUNK_BLOCKS = (0xFFFFFFFF - CHUNK_HEADER.size) // BLOCK_SIZE
+
+def sparse_chunks(new_ranges, zero_ranges, total_blocks):
+    """Lay out the chunks of a sparse image covering |total_blocks|.
+
+    Blocks written by 'new' become RAW chunks, blocks cleared by 'zero'
+    FILL chunks and everything else DONT_CARE. Where ranges overlap 'new'
+    wins, just like in the raw image. Returns a flat array('Q') of type,
+    begin, end triples.
+    """
+    new_ranges = sort_ranges(new_ranges).data
+    zero_ranges = sort_ranges(zero_ranges).data
+    new_starts = new_ranges[0::2]
+    zero_starts = zero_ranges[0::2]
+
+    def covered(ranges, starts, block):
+        i = bisect.bisect_right(starts, block) - 1
+        return i >= 0 and ranges[2*i + 1] > block
+
+    if numpy is not None:
+        bounds = numpy.unique(numpy.concatenate((numpy.frombuffer(new_ranges, dtype=numpy.uint64),
+                                                 numpy.frombuffer(zero_ranges, dtype=numpy.uint64),
+                                                 numpy.array([0, total_blocks], dtype=numpy.uint64))))
+        bounds = array('Q', bounds[bounds <= total_blocks].tobytes())
+    else:
+        bounds = set([0, total_blocks])
+        bounds.update(new_ranges)
+        bounds.update(zero_ranges)
+        bounds = array('Q', sorted(bound for bound in bounds if bound <= total_blocks))
+
+    chunks = array('Q')
+    for begin, end in zip(bounds, islice(bounds, 1, None)):
+        if covered(new_ranges, new_starts, begin):
+            chunk_type = CHUNK_TYPE_RAW
+        elif covered(zero_ranges, zero_starts, begin):
+            chunk_type = CHUNK_TYPE_FILL
+        else:
+            chunk_type = CHUNK_TYPE_DONT_CARE
+        if chunks and chunks[-3] == chunk_type and \
+                (chunk_type != CHUNK_TYPE_RAW or end - chunks[-2] <= MAX_RAW_CHUNK_BLOCKS):
+            chunks[-1] = end
+        else:
+            while chunk_type == CHUNK_TYPE_RAW and end - begin > MAX_RAW_CHUNK_BLOCKS:
+                chunks.extend((chunk_type, begin, begin + MAX_RAW_CHUNK_BLOCKS))
+                begin += MAX_RAW_CHUNK_BLOCKS
+            chunks.extend((chunk_type, begin, end))
+    return chunks
+
+class SparseImageWriter(object):
+    """Writes an Android sparse image laid out from the transfer list.
+
+    All chunk headers are written up front, the payload of the RAW chunks
+    is then filled in by the range copier at the offsets from locate(),
+    in whatever order the 'new' commands deliver it.
+    """
+    def __init__(self, output, chunks, total_blocks):
+        self.output = output
+        self.raw_starts = array('Q')
+        self.raw_ends = array('Q')
+        self.raw_offsets = array('Q')
+        output.write(SPARSE_HEADER.pack(SPARSE_HEADER_MAGIC, 1, 0, SPARSE_HEADER.size, CHUNK_HEADER.size,
+                                        BLOCK_SIZE, total_blocks, len(chunks) // 3, 0))
+        it = iter(chunks)
+        for chunk_type, begin, end in zip(it, it, it):
+            count = end - begin
+            if chunk_type == CHUNK_TYPE_RAW:
+                output.write(CHUNK_HEADER.pack(chunk_type, 0, count, CHUNK_HEADER.size + count*BLOCK_SIZE))
+                self.raw_starts.append(begin)
+                self.raw_ends.append(end)
+                self.raw_offsets.append(output.tell())
+                output.seek(count*BLOCK_SIZE, os.SEEK_CUR)
+            elif chunk_type == CHUNK_TYPE_FILL:
+                output.write(CHUNK_HEADER.pack(chunk_type, 0, count, CHUNK_HEADER.size + 4))
+                output.write(struct.pack('<I', 0))
+            else:
+                output.write(CHUNK_HEADER.pack(chunk_type, 0, count, CHUNK_HEADER.size))
+        self.size = output.tell()
+        output.truncate(self.size)
+        output.flush()
+
+    def locate(self, block):
+        """Returns (file offset, blocks left in its RAW chunk) for |block|."""
+        i = bisect.bisect_right(self.raw_starts, block) - 1
+        return self.raw_offsets[i] + (block - self.raw_starts[i])*BLOCK_SIZE, self.raw_ends[i] - block
+
+# Commands of an incremental (block based) OTA besides erase/new/zero
+DIFF_COMMANDS = ('move', 'bsdiff', 'imgdiff', 'stash', 'free')
+
+def transfer_target(version, tokens):
+    """Returns the target rangeset of a move/bsdiff/imgdiff command, see
+    the transfer list format in bootable/recovery/updater/blockimg.cpp."""
+    cmd = tokens[0]
+    if cmd in ('stash', 'free'):
+        return RangeSet()
+    if version == 1:
+        return rangeset(tokens[2] if cmd == 'move' else tokens[4])
+    if version == 2:
+        return rangeset(tokens[1] if cmd == 'move' else tokens[3])
+    return rangeset(tokens[2] if cmd == 'move' else tokens[5])
+
+def offtin(buf, offset):
+    """Decode a bsdiff sign-magnitude 64-bit integer."""
+    value = struct.unpack_from('<Q', buf, offset)[0]
+    if value & (1 << 63):
+        return -(value & ~(1 << 63))
+    return value
+
+def add_bytes(a, b):
+    """Returns the bytewise sum (mod 256) of two equally long byte strings."""
+    n = len(a)
+    if not n:
+        return b''
+    low = int.from_bytes(b'\x7f' * n, 'little')
+    high = int.from_bytes(b'\x80' * n, 'little')
+    x = int.from_bytes(a, 'little')
+    y = int.from_bytes(b, 'little')
+    return (((x & low) + (y & low)) ^ ((x ^ y) & high)).to_bytes(n, 'little')
+
+def bspatch_block(data, alg):
+    if alg == 0:
+        return data
+    if alg == 1:
+        return bz2.decompress(data)
+    if alg == 2:
+        import brotli
+        try:
+            return brotli.decompress(data)
+        except brotli.error as e:
+            raise Sdat2ImgError('Corrupt bsdiff patch: {}'.format(e))
+    raise Sdat2ImgError('Unknown bsdiff compression {}'.format(alg))
+
+def bspatch(old, patch):
+    """Apply a BSDIFF40 or BSDF2 patch to |old|, returns the new data.
+
+    Uses the bsdiff4 module for BSDIFF40 patches when it is installed.
+    """
+    magic = bytes(patch[:8])
+    if magic == b'BSDIFF40':
+        try:
+            import bsdiff4
+            return bsdiff4.patch(bytes(old), bytes(patch))
+        except ImportError:
+            pass
+        algs = (1, 1, 1)
+    elif magic[:5] == b'BSDF2':
+        algs = tuple(bytearray(magic[5:8]))
+    else:
+        raise Sdat2ImgError('Corrupt bsdiff patch, magic: {!r}'.format(magic))
+
+    ctrl_len = offtin(patch, 8)
+    diff_len = offtin(patch, 16)
+    new_size = offtin(patch, 24)
+    pos = 32
+    ctrl = bspatch_block(bytes(patch[pos:pos + ctrl_len]), algs[0])
+    pos += ctrl_len
+    diff = bspatch_block(bytes(patch[pos:pos + diff_len]), algs[1])
+    pos += diff_len
+    extra = bspatch_block(bytes(patch[pos:]), algs[2])
+
+    new = bytearray(new_size)
+    old_size = len(old)
+    old_pos = new_pos = diff_pos = extra_pos = 0
+    ctrl_pos = 0
+    while new_pos < new_size:
+        x = offtin(ctrl, ctrl_pos)
+        y = offtin(ctrl, ctrl_pos + 8)
+        z = offtin(ctrl, ctrl_pos + 16)
+        ctrl_pos += 24
+        if x < 0 or y < 0 or new_pos + x + y > new_size:
+            raise Sdat2ImgError('Corrupt bsdiff patch')
+
+        # Bytes outside of the old data count as zero
+        begin = min(max(old_pos, 0), old_size)
+        end = min(max(old_pos + x, 0), old_size)
+        source = bytes(begin - old_pos) + bytes(old[begin:end]) if begin > old_pos else bytes(old[begin:end])
+        source += bytes(x - len(source))
+        new[new_pos:new_pos + x] = add_bytes(source, diff[diff_pos:diff_pos + x])
+        diff_pos += x
+        new_pos += x
+        old_pos += x
+
+        new[new_pos:new_pos + y] = extra[extra_pos:extra_pos + y]
+        extra_pos += y
+        new_pos += y
+        old_pos += z
+    return bytes(new)
+
+IMGDIFF_CHUNK_NORMAL = 0
+IMGDIFF_CHUNK_GZIP = 1
+IMGDIFF_CHUNK_DEFLATE = 2
+IMGDIFF_CHUNK_RAW = 3
+
+def imgpatch(old, patch):
+    """Apply an IMGDIFF2 patch to |old|, see bootable/recovery/applypatch/imgpatch.cpp."""
+    if bytes(patch[:8]) != b'IMGDIFF2':
+        raise Sdat2ImgError('Corrupt imgdiff patch, magic: {!r}'.format(bytes(patch[:8])))
+    num_chunks = struct.unpack_from('<i', patch, 8)[0]
+    pos = 12
+    out = []
+    for _ in range(num_chunks):
+        chunk_type = struct.unpack_from('<i', patch, pos)[0]
+        pos += 4
+        if chunk_type == IMGDIFF_CHUNK_NORMAL:
+            src_start, src_len, patch_offset = struct.unpack_from('<3q', patch, pos)
+            pos += 24
+            out.append(bspatch(old[src_start:src_start + src_len], patch[patch_offset:]))
+        elif chunk_type == IMGDIFF_CHUNK_RAW:
+            data_len = struct.unpack_from('<i', patch, pos)[0]
+            pos += 4
+            out.append(bytes(patch[pos:pos + data_len]))
+            pos += data_len
+        elif chunk_type == IMGDIFF_CHUNK_DEFLATE:
+            src_start, src_len, patch_offset, src_expanded_len, target_len = struct.unpack_from('<5q', patch, pos)
+            level, method, window_bits, mem_level, strategy = struct.unpack_from('<5i', patch, pos + 40)
+            pos += 60
+            expanded = zlib.decompressobj(-15).decompress(bytes(old[src_start:src_start + src_len]))
+            if len(expanded) != src_expanded_len:
+                raise Sdat2ImgError('Expanded source has {} bytes, expected {}'.format(len(expanded), src_expanded_len))
+            target = bspatch(expanded, patch[patch_offset:])
+            if len(target) != target_len:
+                raise Sdat2ImgError('Patched chunk has {} bytes, expected {}'.format(len(target), target_len))
+            compressor = zlib.compressobj(level, method, window_bits, mem_level, strategy)
+            out.append(compressor.compress(target) + compressor.flush())
+        else:
+            raise Sdat2ImgError('Unsupported imgdiff chunk type {}'.format(chunk_type))
+    return b''.join(out)
 
-    def parse_transfer_list_file(path):
-        trans_list = open(TRANSFER_LIST_FILE, 'r')
+class BlockImageUpdate(object):
+    """Applies an incremental block OTA on top of a copy of the base image,
+    the way bootable/recovery/updater/blockimg.cpp updates the partition
+    in place. Stashes are kept in memory and may never hold more than the
+    |max_stash_blocks| declared on line 4 of the transfer list.
+    """
+    def __init__(self, image, version, max_stash_blocks, copier, patch_data, progress=None):
+        self.image = image
+        self.progress = progress or (lambda message: None)
+        self.version = version
+        self.max_stash_blocks = max_stash_blocks
+        self.copier = copier
+        self.patch_data = patch_data
+        self.stash = {}
+        self.stashed_blocks = 0
 
+    def read_ranges(self, ranges):
+        data = bytearray(sum(end - begin for begin, end in ranges)*BLOCK_SIZE)
+        view = memoryview(data)
+        pos = 0
+        for begin, end in ranges:
+            self.image.seek(begin*BLOCK_SIZE)
+            want = (end - begin)*BLOCK_SIZE
+            got = 0
+            while got < want:
+                n = self.image.readinto(view[pos + got:pos + want])
+                if not n:
+                    # Blocks beyond the end of the base image read as zeros
+                    break
+                got += n
+            pos += want
+        return data
+
+    def write_ranges(self, ranges, data):
+        view = memoryview(data)
+        pos = 0
+        for begin, end in ranges:
+            self.image.seek(begin*BLOCK_SIZE)
+            want = (end - begin)*BLOCK_SIZE
+            written = 0
+            while written < want:
+                written += self.image.write(view[pos + written:pos + want])
+            pos += want
+
+    def zero_ranges(self, ranges):
+        for begin, end in ranges:
+            for block in range(begin, end, COPY_BUFFER_SIZE // BLOCK_SIZE):
+                count = min(end - block, COPY_BUFFER_SIZE // BLOCK_SIZE)
+                self.write_ranges(((block, block + count),), bytes(count*BLOCK_SIZE))
+
+    def read_patch(self, offset, length):
+        self.patch_data.seek(offset)
+        return self.patch_data.read(length)
+
+    @staticmethod
+    def move_range(dest, locs, source):
+        """Scatter the packed blocks of |source| to the block positions |locs| in |dest|."""
+        pos = 0
+        for begin, end in locs:
+            count = (end - begin)*BLOCK_SIZE
+            dest[begin*BLOCK_SIZE:end*BLOCK_SIZE] = source[pos:pos + count]
+            pos += count
+
+    def save_stash(self, stash_id, data):
+        if stash_id in self.stash:
+            return
+        blocks = len(data) // BLOCK_SIZE
+        if self.max_stash_blocks and self.stashed_blocks + blocks > self.max_stash_blocks:
+            raise Sdat2ImgError('Stashing {} blocks exceeds the declared maximum of {}'.format(
+                self.stashed_blocks + blocks, self.max_stash_blocks))
+        self.stash[stash_id] = data
+        self.stashed_blocks += blocks
+
+    def free_stash(self, stash_id):
+        data = self.stash.pop(stash_id, None)
+        if data is not None:
+            self.stashed_blocks -= len(data) // BLOCK_SIZE
+
+    def load_stash(self, stash_id):
+        if stash_id not in self.stash:
+            raise Sdat2ImgError('Stash {} is missing'.format(stash_id))
+        data = self.stash[stash_id]
+        # Version 2 stashes are freed as soon as they have been used
+        if self.version == 2:
+            self.free_stash(stash_id)
+        return data
+
+    def load_source(self, tokens):
+        """Load '<src_block_count> <src_range|-> [<src_loc>] [<stash_id>:<stash_range> ...]'."""
+        src_blocks = int(tokens[0])
+        buf = bytearray(src_blocks*BLOCK_SIZE)
+        rest = tokens[2:]
+        if tokens[1] != '-':
+            data = self.read_ranges(rangeset(tokens[1]))
+            if rest and ':' not in rest[0]:
+                self.move_range(buf, rangeset(rest[0]), data)
+                rest = rest[1:]
+            else:
+                buf[:len(data)] = data
+        for item in rest:
+            stash_id, locs = item.split(':', 1)
+            self.move_range(buf, rangeset(locs), self.load_stash(stash_id))
+        return buf
+
+    def run(self, cmd, tokens, target):
+        """Execute one transfer command, |tokens| includes the command."""
+        if cmd == 'stash':
+            data = self.read_ranges(rangeset(tokens[2]))
+            if self.version >= 3 and hashlib.sha1(data).hexdigest() != tokens[1]:
+                raise Sdat2ImgError('Stash {} has unexpected contents'.format(tokens[1]))
+            self.save_stash(tokens[1], data)
+        elif cmd == 'free':
+            self.free_stash(tokens[1])
+        elif cmd in ('move', 'bsdiff', 'imgdiff'):
+            if self.version == 1:
+                src_ranges = rangeset(tokens[1] if cmd == 'move' else tokens[3])
+                source = self.read_ranges(src_ranges)
+                src_hash = tgt_hash = None
+            elif self.version == 2:
+                source = self.load_source(tokens[2:] if cmd == 'move' else tokens[4:])
+                src_hash = tgt_hash = None
+            else:
+                if cmd == 'move':
+                    src_hash = tgt_hash = tokens[1]
+                    source = self.load_source(tokens[3:])
+                else:
+                    src_hash, tgt_hash = tokens[3], tokens[4]
+                    source = self.load_source(tokens[6:])
+
+            if src_hash is not None and hashlib.sha1(source).hexdigest() != src_hash:
+                if src_hash in self.stash:
+                    source = self.stash[src_hash]
+                elif hashlib.sha1(self.read_ranges(target)).hexdigest() == tgt_hash:
+                    self.progress('Blocks of {} are already up to date'.format(cmd))
+                    return
+                else:
+                    raise Sdat2ImgError('{} source has unexpected contents (hash {})'.format(cmd, src_hash))
+
+            if cmd == 'move':
+                result = source
+            else:
+                patch = self.read_patch(int(tokens[1]), int(tokens[2]))
+                try:
+                    result = bspatch(source, patch) if cmd == 'bsdiff' else imgpatch(source, patch)
+                except (struct.error, zlib.error, OSError, ValueError, IndexError) as e:
+                    # bz2 raises OSError, bsdiff4 ValueError on bad data
+                    raise Sdat2ImgError('Corrupt {} patch: {}'.format(cmd, e))
+            if tgt_hash is not None and hashlib.sha1(result).hexdigest() != tgt_hash:
+                raise Sdat2ImgError('{} produced unexpected contents (hash {})'.format(cmd, tgt_hash))
+            self.write_ranges(target, result)
+        elif cmd in ('zero', 'erase'):
+            # The base image still holds data there, clear it for real
+            self.zero_ranges(target)
+        elif cmd == 'new':
+            if self.copier is None:
+                raise Sdat2ImgError('The transfer list has new data commands, new data is required')
+            for begin, end in target:
+                if self.copier.copy(begin*BLOCK_SIZE, (end - begin)*BLOCK_SIZE) < (end - begin)*BLOCK_SIZE:
+                    raise Sdat2ImgError('New data ended before block {}'.format(end))
+        else:
+            raise Sdat2ImgError('Command "{}" is not valid.'.format(cmd))
+
+ANDROID_VERSIONS = {
+    1: 'Android Lollipop 5.0',
+    2: 'Android Lollipop 5.1',
+    3: 'Android Marshmallow 6.x',
+    4: 'Android Nougat 7.x / Oreo 8.x',
+}
+
+class TransferList(object):
+    """A parsed transfer list.
+
+    |commands| holds a [command, target RangeSet, tokens] entry for every
+    transfer; stash and free have an empty target, erase, new and zero no
+    tokens.
+    """
+    def __init__(self, version, new_blocks, stash_entries, max_stash_blocks, commands):
+        self.version = version
+        self.new_blocks = new_blocks
+        self.stash_entries = stash_entries
+        self.max_stash_blocks = max_stash_blocks
+        self.commands = commands
+
+    def ranges(self, *names):
+        """All target ranges of the commands in |names|, in list order, as
+        one RangeSet."""
+        data = array('Q')
+        for command in self.commands:
+            if command[0] in names:
+                data.extend(command[1].data)
+        return RangeSet(data)
+
+    @property
+    def total_blocks(self):
+        """Size of the resulting image in blocks."""
+        return max([command[1].end for command in self.commands] + [0])
+
+    def validate(self):
+        """Check the target ranges for empty, inverted or overlapping ranges
+        and their size against the declared block total (vectorized with
+        NumPy when it is installed). Returns a list of problems."""
+        problems = []
+        written = array('Q')
+        for command in self.commands:
+            if command[0] in ('new', 'zero', 'move', 'bsdiff', 'imgdiff'):
+                written.extend(command[1].data)
+
+        if numpy is not None:
+            pairs = numpy.frombuffer(written, dtype=numpy.uint64).reshape(-1, 2)
+            inverted = int((pairs[:, 0] >= pairs[:, 1]).sum())
+            if not inverted:
+                pairs = pairs[numpy.argsort(pairs[:, 0], kind='stable')]
+                overlapping = int((pairs[1:, 0] < pairs[:-1, 1]).sum())
+                blocks = int((pairs[:, 1] - pairs[:, 0]).sum())
+        else:
+            pairs = list(zip(written[0::2], written[1::2]))
+            inverted = sum(1 for begin, end in pairs if begin >= end)
+            if not inverted:
+                pairs.sort()
+                overlapping = sum(1 for a, b in zip(pairs, pairs[1:]) if b[0] < a[1])
+                blocks = sum(end - begin for begin, end in pairs)
+
+        if inverted:
+            problems.append('{} empty or inverted ranges'.format(inverted))
+            return problems
+        if overlapping:
+            problems.append('{} overlapping target ranges'.format(overlapping))
+        if blocks != self.new_blocks:
+            problems.append('{} blocks are written but {} were declared'.format(blocks, self.new_blocks))
+        return problems
+
+    @property
+    def incremental(self):
+        return any(command[0] in DIFF_COMMANDS for command in self.commands)
+
+def parse_transfer_list(lines):
+    """Parse a transfer list from an iterable of lines."""
+    lines = iter(lines)
+    try:
         # First line in transfer list is the version number
-        version = int(trans_list.readline())
+        version = int(next(lines))
 
         # Second line in transfer list is the total number of blocks we expect to write
-        new_blocks = int(trans_list.readline())
+        new_blocks = int(next(lines))
 
+        stash_entries = max_stash_blocks = 0
         if version >= 2:
             # Third line is how many stash entries are needed simultaneously
-            trans_list.readline()
+            stash_entries = int(next(lines))
             # Fourth line is the maximum number of blocks that will be stashed simultaneously
-            trans_list.readline()
-
-        # Subsequent lines are all individual transfer commands
-        commands = []
-        for line in trans_list:
-            line = line.split(' ')
-            cmd = line[0]
-            if cmd in ['erase', 'new', 'zero']:
-                commands.append([cmd, rangeset(line[1])])
+            max_stash_blocks = int(next(lines))
+    except (StopIteration, ValueError):
+        raise Sdat2ImgError('Truncated or corrupt transfer list header')
+
+    # Subsequent lines are all individual transfer commands
+    commands = []
+    for line in lines:
+        line = line.split()
+        if not line:
+            continue
+        cmd = line[0]
+        if cmd in ['erase', 'new', 'zero']:
+            commands.append([cmd, rangeset(line[1]), None])
+        elif cmd in DIFF_COMMANDS:
+            commands.append([cmd, transfer_target(version, line), line])
+        elif not cmd[0].isdigit():
+            # Lines starting with numbers are not commands anyway
+            raise Sdat2ImgError('Command "{}" is not valid.'.format(cmd))
+
+    return TransferList(version, new_blocks, stash_entries, max_stash_blocks, commands)
+
+def parse_transfer_list_file(path):
+    with open(path, 'r') as trans_list:
+        return parse_transfer_list(trans_list)
+
+def load_transfer_list(transfer_list):
+    """Accepts a TransferList or the path of a transfer list file."""
+    if isinstance(transfer_list, TransferList):
+        return transfer_list
+    return parse_transfer_list_file(transfer_list)
+
+def new_data_reader(new_data):
+    """Returns (reader, owned) for a new data spec or an open file object."""
+    if hasattr(new_data, 'readinto'):
+        return new_data, False
+    return open_new_data(new_data), True
+
+def iter_extents(transfer_list, new_data, buffer_size=COPY_BUFFER_SIZE):
+    """Yield (image offset, memoryview) pairs covering all of the new data.
+
+    Extents come in transfer list order. The view points into a reused
+    buffer and is only valid until the next extent is requested; zero and
+    erase ranges are not yielded and read as zeros in the image.
+    """
+    transfer_list = load_transfer_list(transfer_list)
+    reader, owned = new_data_reader(new_data)
+    view = memoryview(bytearray(buffer_size))
+    try:
+        for begin, end in merge_ranges(transfer_list.ranges('new')):
+            offset = begin*BLOCK_SIZE
+            length = (end - begin)*BLOCK_SIZE
+            while length > 0:
+                n = reader.readinto(view[:min(length, buffer_size)])
+                if not n:
+                    raise Sdat2ImgError('New data ended {} bytes early'.format(length))
+                yield offset, view[:n]
+                offset += n
+                length -= n
+    finally:
+        if owned:
+            reader.close()
+
+def extend_image(sink, size):
+    """Grow |sink| to at least |size| bytes, returns its final size."""
+    current = sink.seek(0, os.SEEK_END)
+    if current < size:
+        sink.truncate(size)
+        # Some file objects (e.g. io.BytesIO) can't grow through truncate()
+        if sink.seek(0, os.SEEK_END) < size:
+            sink.seek(size - 1)
+            sink.write(b'\0')
+        current = size
+    return current
+
+def image_locator(writer):
+    """Returns locate(block) -> (output offset, contiguous blocks) for a
+    raw image, or for a sparse image when |writer| is given."""
+    if writer is not None:
+        return writer.locate
+    return lambda block: (block*BLOCK_SIZE, float('inf'))
+
+def image_extents(ranges, locate):
+    """Yield (new data offset, output offset, length) for merged |ranges|."""
+    offsets = new_data_offsets(ranges)
+    for i, (begin, end) in enumerate(ranges):
+        src_offset = offsets[i]
+        while begin < end:
+            dst_offset, count = locate(begin)
+            count = min(count, end - begin)
+            yield src_offset, dst_offset, count*BLOCK_SIZE
+            src_offset += count*BLOCK_SIZE
+            begin += count
+
+# Output written between two checkpoints of a resumable conversion
+CHECKPOINT_INTERVAL = 1024 * 1024 * 256
+
+def extents_sha1(sink, extents):
+    """SHA-1 of the bytes of |sink| at the [offset, length] |extents|."""
+    sha1 = hashlib.sha1()
+    for offset, length in extents:
+        while length > 0:
+            n = min(length, COPY_BUFFER_SIZE)
+            if has_fileno(sink):
+                data = os.pread(sink.fileno(), n, offset)
             else:
-                # Skip lines starting with numbers, they are not commands anyway
-                if not cmd[0].isdigit():
-                    print('Command "{}" is not valid.'.format(cmd), file=sys.stderr)
-                    trans_list.close()
-                    sys.exit(1)
+                sink.seek(offset)
+                data = sink.read(n)
+            if not data:
+                break
+            sha1.update(data)
+            offset += len(data)
+            length -= len(data)
+    return sha1.digest()
 
-        trans_list.close()
-        return version, new_blocks, commands
+class Checkpoint(object):
+    """Sidecar file recording how far write_image() got, so that an
+    interrupted conversion continues where it stopped.
 
-    BLOCK_SIZE = 4096
-    
-    version, new_blocks, commands = parse_transfer_list_file(TRANSFER_LIST_FILE)
+    Every |interval| bytes the output is fsync()ed and the sidecar records
+    the extents and new data bytes done plus a running hash: the SHA-1 of
+    the previous digest and of the output written since. On resume the
+    last segment is read back and checked against it.
+    """
+    def __init__(self, path, key, interval=CHECKPOINT_INTERVAL):
+        self.path = path
+        self.key = key
+        self.interval = interval
+        self.state = {'key': key, 'extent': 0, 'src_offset': 0, 'digest': '', 'prev_digest': '', 'segment': []}
+        self.pending = []
+        self.pending_bytes = 0
+        self.extent = 0
+        self.src_offset = 0
 
-    if version == 1:
-        print('Android Lollipop 5.0 detected!\n')
-    elif version == 2:
-        print('Android Lollipop 5.1 detected!\n')
-    elif version == 3:
-        print('Android Marshmallow 6.x detected!\n')
-    elif version == 4:
-        print('Android Nougat 7.x / Oreo 8.x detected!\n')
+    def load(self, sink):
+        """Returns the saved state if it belongs to this conversion and the
+        output still holds the last checkpointed segment, else None."""
+        try:
+            with open(self.path, 'r') as f:
+                state = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if state.get('key') != self.key:
+            return None
+        segment = extents_sha1(sink, state['segment'])
+        if hashlib.sha1(bytes.fromhex(state['prev_digest']) + segment).hexdigest() != state['digest']:
+            return None
+        self.state = state
+        return state
+
+    def update(self, sink, extent, src_offset, dst_offset, length):
+        """Record a copied extent, saving a checkpoint every |interval| bytes."""
+        self.pending.append([dst_offset, length])
+        self.pending_bytes += length
+        self.extent = extent
+        self.src_offset = src_offset
+        if self.pending_bytes >= self.interval:
+            self.save(sink)
+
+    def save(self, sink):
+        sink.flush()
+        if has_fileno(sink):
+            os.fsync(sink.fileno())
+        prev_digest = self.state['digest']
+        digest = hashlib.sha1(bytes.fromhex(prev_digest) + extents_sha1(sink, self.pending)).hexdigest()
+        self.state.update(extent=self.extent, src_offset=self.src_offset, digest=digest,
+                          prev_digest=prev_digest, segment=self.pending)
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self.state, f)
+        os.replace(self.path + '.tmp', self.path)
+        self.pending = []
+        self.pending_bytes = 0
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+def checkpoint_key(transfer_list_path, new_data, **options):
+    """Identifies a conversion: transfer list contents, new data parts and options."""
+    with open(transfer_list_path, 'rb') as f:
+        key = {'transfer_list': hashlib.sha1(f.read()).hexdigest()}
+    key['new_data'] = [[os.path.abspath(path), os.path.getsize(path)] for path in resolve_new_data_parts(new_data)]
+    key.update(options)
+    return key
+
+def skip_new_data(reader, length):
+    """Move |reader| |length| bytes forward, by reading if it can't seek."""
+    if reader.seekable():
+        reader.seek(length, os.SEEK_CUR)
+        return
+    buf = memoryview(bytearray(min(length, COPY_BUFFER_SIZE) or 1))
+    while length > 0:
+        n = reader.readinto(buf[:min(length, len(buf))])
+        if not n:
+            raise Sdat2ImgError('New data ended {} bytes early'.format(length))
+        length -= n
+
+def write_image(transfer_list, new_data, sink, sparse=False, simg=False, progress=None, threads=1,
+                checkpoint=None):
+    """Convert |new_data| into |sink|, any seekable binary file object.
+
+    |new_data| is a path, glob or list of parts (see open_new_data()) or an
+    open file object. With |sparse| all-zero blocks are seeked over, so
+    |sink| must start out empty; with |simg| an Android sparse image is
+    written. |progress| is called with a message for every step. With
+    |threads| > 1 uncompressed new data is copied by that many threads.
+    With a |checkpoint| the conversion is resumable: progress is recorded
+    as it goes and a matching earlier run is continued, |sink| must then
+    be readable too. Returns the size of the image written.
+    """
+    progress = progress or (lambda message: None)
+    transfer_list = load_transfer_list(transfer_list)
+    if transfer_list.incremental:
+        raise Sdat2ImgError('This is an incremental transfer list, a base image and patch data are required')
+
+    max_file_size = transfer_list.total_blocks*BLOCK_SIZE
+    for command in transfer_list.commands:
+        if command[0] != 'new':
+            progress('Skipping command {}...'.format(command[0]))
+    new_ranges = transfer_list.ranges('new')
+
+    reader, owned = new_data_reader(new_data)
+    try:
+        state = None
+        if checkpoint is not None:
+            state = checkpoint.load(sink)
+            if state is None:
+                # Whatever is there belongs to some other conversion
+                sink.seek(0)
+                sink.truncate(0)
+
+        writer = None
+        if simg:
+            total_blocks = transfer_list.total_blocks
+            chunks = sparse_chunks(new_ranges, transfer_list.ranges('zero'), total_blocks)
+            writer = SparseImageWriter(sink, chunks, total_blocks)
+
+        locate = image_locator(writer)
+        merged = merge_ranges(new_ranges)
+        # 'zero' and 'erase' ranges are never written, so they stay holes
+        if threads > 1 and checkpoint is None and ParallelRangeWriter.supported(reader, sink):
+            copier = ParallelRangeWriter(reader, sink, threads, sparse=sparse and not simg)
+            progress('Copying {} ranges with {} threads...'.format(len(merged), threads))
+            copier.write(image_extents(merged, locate))
+        else:
+            skip = 0
+            consumed = 0
+            if state is not None:
+                skip = state['extent']
+                consumed = state['src_offset']
+                progress('Resuming after {} bytes of new data...'.format(consumed))
+                skip_new_data(reader, consumed)
+            # Blocks past the checkpoint may hold data of the interrupted
+            # run, so they can't be left as holes when resuming
+            copier = RangeCopier(reader, sink, sparse=sparse and not simg and state is None)
+            index = 0
+            for begin, end in merged:
+                extents = list(image_extents([(begin, end)], locate))
+                if index + len(extents) <= skip:
+                    index += len(extents)
+                    continue
+                progress('Copying {} blocks into position {}...'.format(end - begin, begin))
+                for src_offset, dst_offset, length in extents:
+                    index += 1
+                    if index <= skip:
+                        continue
+                    if copier.copy(dst_offset, length) < length:
+                        raise Sdat2ImgError('New data ended before block {}'.format(end))
+                    consumed += length
+                    if checkpoint is not None:
+                        checkpoint.update(sink, index, consumed, dst_offset, length)
+        if sparse and not simg:
+            progress('Left {} all-zero blocks as holes'.format(copier.skipped // BLOCK_SIZE))
+    finally:
+        if owned:
+            reader.close()
+
+    if writer is not None:
+        size = writer.size
     else:
-        print('Unknown Android version!\n')
+        # Make file larger if necessary
+        size = extend_image(sink, max_file_size)
+    if checkpoint is not None:
+        checkpoint.remove()
+    return size
+
+# Out-of-order new data kept in memory by an ImageHasher before it falls
+# back to reading it again from the raw image
+MAX_PENDING_HASH_BYTES = 1024 * 1024 * 256
+
+class ImageHasher(object):
+    """Rolling hashes of a final raw image, fed in transfer list order.
+
+    The image is hashed front to back: the gaps between 'new' ranges are
+    hashed as zeros and data arriving ahead of the cursor is held back
+    until the cursor gets there. Up to |max_pending| bytes are held in
+    memory, past that only their position is kept and |readback|(offset,
+    length) is called to fetch them from the written image instead.
+    """
+    def __init__(self, new_ranges, size, algorithms=('sha1', 'sha256'), readback=None,
+                 max_pending=MAX_PENDING_HASH_BYTES):
+        self.names = list(algorithms)
+        try:
+            self.hashes = [hashlib.new(name) for name in self.names]
+        except ValueError as e:
+            raise Sdat2ImgError(str(e))
+        # Merged 'new' blocks in image order
+        self.covered = merge_ranges(sort_ranges(new_ranges))
+        self.index = 0
+        self.cursor = 0
+        self.size = size
+        self.readback = readback
+        self.max_pending = max_pending
+        self.pending = {}
+        self.pending_bytes = 0
+        self.zeros = None
+
+    def _update(self, data):
+        for h in self.hashes:
+            h.update(data)
+
+    def _zero_fill(self, end):
+        if self.zeros is None:
+            self.zeros = memoryview(bytes(COPY_BUFFER_SIZE))
+        while self.cursor < end:
+            n = min(end - self.cursor, COPY_BUFFER_SIZE)
+            self._update(self.zeros[:n])
+            self.cursor += n
+
+    def feed(self, offset, data):
+        """Hash |data| found at image |offset|."""
+        if offset == self.cursor:
+            self._update(data)
+            self.cursor += len(data)
+        elif self.readback is None or self.pending_bytes + len(data) <= self.max_pending:
+            self.pending[offset] = bytes(data)
+            self.pending_bytes += len(data)
+        else:
+            self.pending[offset] = len(data)
+        self._advance()
 
-    # Don't clobber existing files to avoid accidental data loss
+    def _advance(self):
+        while self.cursor < self.size:
+            while self.index < len(self.covered) and self.covered[self.index][1]*BLOCK_SIZE <= self.cursor:
+                self.index += 1
+            if self.index == len(self.covered) or self.covered[self.index][0]*BLOCK_SIZE > self.cursor:
+                end = self.covered[self.index][0]*BLOCK_SIZE if self.index < len(self.covered) else self.size
+                self._zero_fill(min(end, self.size))
+                continue
+            data = self.pending.pop(self.cursor, None)
+            if data is None:
+                return
+            if isinstance(data, bytes):
+                self.pending_bytes -= len(data)
+            else:
+                data = self.readback(self.cursor, data)
+            self._update(data)
+            self.cursor += len(data)
+
+    def hexdigests(self):
+        """Returns {algorithm: hex digest} once the whole image was fed."""
+        self._advance()
+        if self.cursor < self.size or self.pending:
+            raise Sdat2ImgError('Image hash is incomplete at offset {}'.format(self.cursor))
+        return dict((name, h.hexdigest()) for name, h in zip(self.names, self.hashes))
+
+def sparse_readback(fd, locate):
+    """Returns readback(offset, length) reading raw image data back out of
+    the RAW chunks of a sparse image being written to |fd|."""
+    def readback(offset, length):
+        data = []
+        while length > 0:
+            block, within = divmod(offset, BLOCK_SIZE)
+            dst_offset, count = locate(block)
+            n = min(count*BLOCK_SIZE - within, length)
+            data.append(os.pread(fd, n, dst_offset + within))
+            offset += n
+            length -= n
+        return b''.join(data)
+    return readback
+
+def write_sinks(transfer_list, new_data, raw=None, simg=None, hashes=(), sparse=False, progress=None):
+    """Convert |new_data| into several outputs with one pass over it.
+
+    Any of a raw image |raw|, an Android sparse image |simg| (both
+    seekable binary file objects) and the hashlib |hashes| of the final
+    raw image are produced from the same reads. With |sparse| all-zero
+    blocks are seeked over in |raw|. Hashing data that arrives out of
+    image order may read it back from |raw|, or else from |simg|, which
+    must then be readable too. Returns a dict with the image 'size', the 'simg_size' and one
+    hex digest per hash.
+    """
+    progress = progress or (lambda message: None)
+    transfer_list = load_transfer_list(transfer_list)
+    if transfer_list.incremental:
+        raise Sdat2ImgError('This is an incremental transfer list, a base image and patch data are required')
+
+    total_blocks = transfer_list.total_blocks
+    max_file_size = total_blocks*BLOCK_SIZE
+    new_ranges = transfer_list.ranges('new')
+    writer = None
+    if simg is not None:
+        chunks = sparse_chunks(new_ranges, transfer_list.ranges('zero'), total_blocks)
+        writer = SparseImageWriter(simg, chunks, total_blocks)
+    hasher = None
+    if hashes:
+        # Data held back for hashing is read again from an output past max_pending
+        if raw is not None and has_fileno(raw) and raw.readable():
+            readback_sink = raw
+            readback = lambda offset, length: os.pread(raw.fileno(), length, offset)
+        elif writer is not None and has_fileno(simg) and simg.readable():
+            readback_sink = simg
+            readback = sparse_readback(simg.fileno(), writer.locate)
+        else:
+            raise Sdat2ImgError('Hashing needs a readable raw or sparse image to read held back data from')
+        hasher = ImageHasher(new_ranges, max_file_size, hashes, readback)
+
+    reader, owned = new_data_reader(new_data)
+    buf = bytearray(COPY_BUFFER_SIZE)
+    view = memoryview(buf)
+    skipped = 0
     try:
-        output_img = open(OUTPUT_IMAGE_FILE, 'wb')
-    except IOError as e:
-        if e.errno == errno.EEXIST:
-            print('Error: the output file "{}" already exists'.format(e.filename), file=sys.stderr)
-            print('Remove it, rename it, or choose a different file name.', file=sys.stderr)
-            sys.exit(e.errno)
-        else:
-            raise
-
-    new_data_file = open(NEW_DATA_FILE, 'rb')
-    all_block_sets = [i for command in commands for i in command[1]]
-    max_file_size = max(pair[1] for pair in all_block_sets)*BLOCK_SIZE
-
-    for command in commands:
-        if command[0] == 'new':
-            for block in command[1]:
-                begin = block[0]
-                end = block[1]
-                block_count = end - begin
-                print('Copying {} blocks into position {}...'.format(block_count, begin))
-
-                # Position output file
-                output_img.seek(begin*BLOCK_SIZE)
-                
-                # Copy one block at a time
-                while(block_count > 0):
-                    output_img.write(new_data_file.read(BLOCK_SIZE))
-                    block_count -= 1
-        else:
-            print('Skipping command {}...'.format(command[0]))
-
-    # Make file larger if necessary
-    if(output_img.tell() < max_file_size):
-        output_img.truncate(max_file_size)
-
-    output_img.close()
-    new_data_file.close()
-    print('Done! Output image: {}'.format(os.path.realpath(output_img.name)))
+        for begin, end in merge_ranges(new_ranges):
+            progress('Copying {} blocks into position {}...'.format(end - begin, begin))
+            offset = begin*BLOCK_SIZE
+            length = (end - begin)*BLOCK_SIZE
+            while length > 0:
+                n = read_fully(reader, view[:min(length, COPY_BUFFER_SIZE)])
+                if not n:
+                    raise Sdat2ImgError('New data ended before block {}'.format(end))
+                if raw is not None:
+                    runs = data_runs(buf, n) if sparse else [(0, n)]
+                    for run_begin, run_end in runs:
+                        raw.seek(offset + run_begin)
+                        raw.write(view[run_begin:run_end])
+                        skipped -= run_end - run_begin
+                    skipped += n
+                if writer is not None:
+                    done = 0
+                    while done < n:
+                        # Reads end short of a block at the end of the new data
+                        block, within = divmod(offset + done, BLOCK_SIZE)
+                        dst_offset, count = writer.locate(block)
+                        count = min(count*BLOCK_SIZE - within, n - done)
+                        simg.seek(dst_offset + within)
+                        simg.write(view[done:done + count])
+                        done += count
+                if hasher is not None:
+                    readback_sink.flush()
+                    hasher.feed(offset, view[:n])
+                offset += n
+                length -= n
+    finally:
+        if owned:
+            reader.close()
 
-if __name__ == '__main__':
+    result = {'size': max_file_size, 'simg_size': None}
+    if raw is not None:
+        if sparse:
+            progress('Left {} all-zero blocks as holes'.format(skipped // BLOCK_SIZE))
+        # Make file larger if necessary
+        result['size'] = extend_image(raw, max_file_size)
+    if writer is not None:
+        simg.flush()
+        result['simg_size'] = writer.size
+    if hasher is not None:
+        result.update(hasher.hexdigests())
+    return result
+
+class VirtualImage(io.RawIOBase):
+    """Read-only, seekable view of the image a transfer list describes,
+    served straight from uncompressed new data without writing an image.
+
+    Image offsets are mapped to new data offsets through a sorted range
+    index (bisect over array('Q') columns); unmapped regions read as zeros.
+    Use open_image() for a buffered version suitable for small reads.
+    """
+    def __init__(self, transfer_list, new_data):
+        super(VirtualImage, self).__init__()
+        transfer_list = load_transfer_list(transfer_list)
+        if transfer_list.incremental:
+            raise Sdat2ImgError('Incremental transfer lists can not be read lazily')
+        self.size = transfer_list.total_blocks*BLOCK_SIZE
+
+        merged = merge_ranges(transfer_list.ranges('new'))
+        offsets = new_data_offsets(merged)
+        if numpy is not None:
+            pairs = range_pairs(merged.data)
+            order = numpy.argsort(pairs[:, 0], kind='stable')
+            self.starts = array('Q', pairs[order, 0].tobytes())
+            self.ends = array('Q', pairs[order, 1].tobytes())
+            self.offsets = array('Q', numpy.frombuffer(offsets, dtype=numpy.uint64)[order].tobytes())
+        else:
+            order = sorted(range(len(merged)), key=lambda i: merged[i][0])
+            self.starts = array('Q', (merged[i][0] for i in order))
+            self.ends = array('Q', (merged[i][1] for i in order))
+            self.offsets = array('Q', (offsets[i] for i in order))
+
+        self.reader, self.owned = new_data_reader(new_data)
+        if not self.reader.seekable():
+            if self.owned:
+                self.reader.close()
+            raise Sdat2ImgError('Lazy reading needs uncompressed new data')
+        self.base = self.reader.tell()
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError('negative seek position {}'.format(offset))
+        self.pos = offset
+        return offset
+
+    def readinto(self, b):
+        view = memoryview(b).cast('B')
+        want = max(min(len(view), self.size - self.pos), 0)
+        done = 0
+        while done < want:
+            pos = self.pos + done
+            i = bisect.bisect_right(self.starts, pos // BLOCK_SIZE) - 1
+            if i >= 0 and self.ends[i]*BLOCK_SIZE > pos:
+                n = min(want - done, self.ends[i]*BLOCK_SIZE - pos)
+                self.reader.seek(self.base + self.offsets[i] + pos - self.starts[i]*BLOCK_SIZE)
+                got = 0
+                while got < n:
+                    r = self.reader.readinto(view[done + got:done + n])
+                    if not r:
+                        # Missing new data reads as zeros too
+                        view[done + got:done + n] = bytes(n - got)
+                        break
+                    got += r
+            else:
+                next_start = self.starts[i + 1]*BLOCK_SIZE if i + 1 < len(self.starts) else self.size
+                n = min(want - done, next_start - pos)
+                view[done:done + n] = bytes(n)
+            done += n
+        self.pos += done
+        return done
+
+    def close(self):
+        if not self.closed and self.owned:
+            self.reader.close()
+        super(VirtualImage, self).close()
+
+def open_image(transfer_list, new_data, buffer_size=io.DEFAULT_BUFFER_SIZE):
+    """Open the image described by |transfer_list| for reading, without
+    converting it. Returns a buffered, seekable binary file object."""
+    return io.BufferedReader(VirtualImage(transfer_list, new_data), buffer_size)
+
+def apply_incremental(transfer_list, base_image, new_data, patch_data, sink, progress=None, target_size=None):
+    """Write the target image of an incremental OTA from |base_image|.
+
+    |sink| must be readable as well as writable, commands read their
+    source blocks back from it. |new_data| and |patch_data| may be None
+    when the transfer list doesn't need them. Unchanged blocks are left
+    out of a transfer list, so the image keeps the size of the base image
+    unless the commands reach further, or |target_size| is given.
+    """
+    progress = progress or (lambda message: None)
+    transfer_list = load_transfer_list(transfer_list)
+    with open(base_image, 'rb') as base_img:
+        progress('Copying base image {}...'.format(base_image))
+        RangeCopier(base_img, sink).copy(0, os.fstat(base_img.fileno()).st_size)
+
+    new_data_file = None
+    patch_data_file = None
     try:
-        TRANSFER_LIST_FILE = str(sys.argv[1])
-        NEW_DATA_FILE = str(sys.argv[2])
-    except IndexError:
-        print('\nUsage: sdat2img.py <transfer_list> <system_new_file> [system_img]\n')
-        print('    <transfer_list>: transfer list file')
-        print('    <system_new_file>: system new dat file')
-        print('    [system_img]: output system image\n\n')
-        print('Visit xda thread for more information.\n')
+        copier = None
+        if new_data is not None:
+            new_data_file, owned = new_data_reader(new_data)
+            copier = RangeCopier(new_data_file, sink)
+        if patch_data is not None:
+            patch_data_file = open(patch_data, 'rb')
+        update = BlockImageUpdate(sink, transfer_list.version, transfer_list.max_stash_blocks,
+                                  copier, patch_data_file, progress)
+        for command in transfer_list.commands:
+            progress('Performing command {}...'.format(command[0]))
+            update.run(command[0], command[2], command[1])
+    finally:
+        if new_data_file is not None and owned:
+            new_data_file.close()
+        if patch_data_file is not None:
+            patch_data_file.close()
+
+    if target_size is not None:
+        sink.truncate(target_size)
+    else:
+        extend_image(sink, transfer_list.total_blocks*BLOCK_SIZE)
+
+def main(TRANSFER_LIST_FILE, NEW_DATA_FILE, OUTPUT_IMAGE_FILE, sparse=False, simg=False,
+         BASE_IMAGE_FILE=None, PATCH_DATA_FILE=None, threads=1, resume=False, SIMG_OUTPUT_FILE=None, hashes=()):
+    __version__ = '1.2'
+
+    if sys.hexversion < 0x02070000:
+        print >> sys.stderr, "Python 2.7 or newer is required."
         try:
             input = raw_input
         except NameError: pass
         input('Press ENTER to exit...')
-        sys.exit()
+        sys.exit(1)
+    else:
+        print('sdat2img binary - version: {}\n'.format(__version__))
+
+    try:
+        transfer_list = parse_transfer_list_file(TRANSFER_LIST_FILE)
+        for problem in transfer_list.validate():
+            print('Warning: {}'.format(problem), file=sys.stderr)
+
+        if transfer_list.version in ANDROID_VERSIONS:
+            print('{} detected!\n'.format(ANDROID_VERSIONS[transfer_list.version]))
+        else:
+            print('Unknown Android version!\n')
+
+        # Each mode takes only some of the options, refuse the rest instead of ignoring them
+        one_pass = SIMG_OUTPUT_FILE is not None or bool(hashes)
+        options = [('--sparse', sparse), ('--simg', simg), ('--threads', threads > 1), ('--resume', resume),
+                   ('--simg-out', SIMG_OUTPUT_FILE is not None), ('--hash', bool(hashes))]
+        if BASE_IMAGE_FILE is not None:
+            mode, supported = '--base', ()
+        elif resume:
+            mode, supported = '--resume', ('--sparse', '--simg', '--resume')
+        elif one_pass:
+            mode, supported = '--simg-out/--hash', ('--sparse', '--simg', '--simg-out', '--hash')
+        else:
+            mode, supported = None, None
+        if mode is not None:
+            unsupported = [name for name, used in options if used and name not in supported]
+            if unsupported:
+                raise Sdat2ImgError('{} can\'t be used with {}'.format(', '.join(unsupported), mode))
+
+        if BASE_IMAGE_FILE is not None:
+            with open(OUTPUT_IMAGE_FILE, 'w+b', buffering=0) as output_img:
+                apply_incremental(transfer_list, BASE_IMAGE_FILE, NEW_DATA_FILE, PATCH_DATA_FILE, output_img,
+                                  progress=print)
+        elif resume:
+            checkpoint = Checkpoint(OUTPUT_IMAGE_FILE + '.ckpt',
+                                    checkpoint_key(TRANSFER_LIST_FILE, NEW_DATA_FILE, sparse=sparse, simg=simg))
+            # Keep what an interrupted run already wrote
+            mode = 'r+b' if os.path.exists(OUTPUT_IMAGE_FILE) else 'w+b'
+            with open(OUTPUT_IMAGE_FILE, mode) as output_img:
+                write_image(transfer_list, NEW_DATA_FILE, output_img, sparse=sparse, simg=simg, progress=print,
+                            checkpoint=checkpoint)
+        elif SIMG_OUTPUT_FILE is not None or hashes:
+            if simg and SIMG_OUTPUT_FILE is not None:
+                raise Sdat2ImgError('--simg-out writes the sparse image already, leave out --simg')
+            # One pass over the new data feeds every output and hash
+            outputs = {}
+            try:
+                outputs['simg' if simg else 'raw'] = open(OUTPUT_IMAGE_FILE, 'w+b')
+                if SIMG_OUTPUT_FILE is not None:
+                    outputs['simg'] = open(SIMG_OUTPUT_FILE, 'w+b')
+                result = write_sinks(transfer_list, NEW_DATA_FILE, hashes=hashes, sparse=sparse, progress=print,
+                                     **outputs)
+            finally:
+                for output in outputs.values():
+                    output.close()
+            for name in hashes:
+                print('{}: {}'.format(name, result[name]))
+        else:
+            # Don't clobber existing files to avoid accidental data loss
+            try:
+                output_img = open(OUTPUT_IMAGE_FILE, 'wb')
+            except IOError as e:
+                if e.errno == errno.EEXIST:
+                    print('Error: the output file "{}" already exists'.format(e.filename), file=sys.stderr)
+                    print('Remove it, rename it, or choose a different file name.', file=sys.stderr)
+                    sys.exit(e.errno)
+                else:
+                    raise
+            with output_img:
+                write_image(transfer_list, NEW_DATA_FILE, output_img, sparse=sparse, simg=simg, progress=print,
+                            threads=threads)
+    except Sdat2ImgError as e:
+        print('Error: {}'.format(e), file=sys.stderr)
+        sys.exit(1)
+
+    print('Done! Output image: {}'.format(os.path.realpath(OUTPUT_IMAGE_FILE)))
+
+# Suffixes tried when looking up the new data next to a transfer list
+NEW_DATA_SUFFIXES = ('.new.dat', '.new.dat.br', '.new.dat.xz', '.new.dat.zst')
+
+def find_new_data(transfer_list_path):
+    """Returns the new data spec belonging to NAME.transfer.list, if any."""
+    prefix = re.sub(r'\.transfer\.list$', '', transfer_list_path)
+    for suffix in NEW_DATA_SUFFIXES:
+        try:
+            resolve_new_data_parts(prefix + suffix)
+        except IOError:
+            continue
+        return prefix + suffix
+    return None
 
+# Members of block based OTA zips: NAME.transfer.list and
+# NAME.new.dat[.br|.xz|.zst][.N], where Oplus OTAs put their NV ID between
+# name and suffix, e.g. my_bigball.00011011.new.dat.br
+OTA_MEMBER_RE = re.compile(r'^(\w+?)(?:\.\d+)?\.(transfer\.list|new\.dat(?:\.[\w.]+)?)$')
+
+def zip_partitions(zip_path):
+    """Find the partitions of a block based OTA zip. Returns {name:
+    (transfer list member, [new data members])} for each partition which
+    has both."""
+    transfer_lists = {}
+    new_data = {}
+    with zipfile.ZipFile(zip_path) as archive:
+        for member in archive.namelist():
+            match = OTA_MEMBER_RE.match(member.rsplit('/', 1)[-1])
+            if not match:
+                continue
+            name, kind = match.groups()
+            if kind == 'transfer.list':
+                transfer_lists[name] = member
+            else:
+                new_data.setdefault(name, []).append(member)
+    return dict((name, (member, sorted(new_data[name], key=part_number)))
+                for name, member in transfer_lists.items() if name in new_data)
+
+def convert_job(job):
+    """Run one batch job, returns its result dict instead of raising."""
+    transfer_list, new_data, output, options = job
+    result = {'name': os.path.basename(output), 'output': output, 'size': 0, 'error': None}
+    start = time.time()
+    try:
+        if new_data is None:
+            raise Sdat2ImgError('No new data found for {}'.format(transfer_list))
+        with open(output, 'wb') as sink:
+            result['size'] = write_image(transfer_list, new_data, sink, **options)
+    except Exception as e:
+        # Corrupt input raises each decoder's own error (lzma.LZMAError,
+        # brotli.error, zstd.ZstdError, ...), which must not end the batch
+        result['error'] = str(e) or type(e).__name__
+    result['seconds'] = time.time() - start
+    return result
+
+def convert_batch(jobs, workers=None, sparse=False, simg=False, threads=1):
+    """Convert many (transfer_list, new_data, output) jobs in a process pool.
+
+    At most |workers| (default: CPU count) partitions are converted at the
+    same time. Yields a result dict (name, output, size, seconds, error)
+    per job as soon as it finishes.
+    """
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    options = {'sparse': sparse, 'simg': simg, 'threads': threads}
+    jobs = [(transfer_list, new_data, output, options) for transfer_list, new_data, output in jobs]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for future in as_completed([pool.submit(convert_job, job) for job in jobs]):
+            yield future.result()
+
+def batch_main(transfer_lists, outdir, workers=None, sparse=False, simg=False, threads=1):
+    """Convert NAME.transfer.list + NAME.new.dat[.br|.xz|.zst] pairs into
+    outdir/NAME.img in parallel and report per-partition timings."""
     try:
-        OUTPUT_IMAGE_FILE = str(sys.argv[3])
-    except IndexError:
-        OUTPUT_IMAGE_FILE = 'system.img'
+        os.makedirs(outdir, exist_ok=True)
+    except EnvironmentError as e:
+        print('Error: {}'.format(e), file=sys.stderr)
+        return 1
+    jobs = []
+    for transfer_list in transfer_lists:
+        name = re.sub(r'\.transfer\.list$', '', os.path.basename(transfer_list))
+        jobs.append((transfer_list, find_new_data(transfer_list), os.path.join(outdir, name + '.img')))
+    return report_batch(jobs, workers, sparse=sparse, simg=simg, threads=threads)
+
+def zip_main(zip_path, outdir, workers=None, sparse=False, simg=False, threads=1, partitions=None):
+    """Convert the partitions of a block based OTA zip into outdir/NAME.img,
+    streaming transfer lists and new data out of the zip. With
+    |partitions| only those present in the zip are converted."""
+    try:
+        os.makedirs(outdir, exist_ok=True)
+        found = zip_partitions(zip_path)
+        jobs = []
+        with zipfile.ZipFile(zip_path) as archive:
+            for name in sorted(found):
+                if partitions is not None and name not in partitions:
+                    continue
+                transfer_list, members = found[name]
+                with archive.open(transfer_list) as member:
+                    lines = io.TextIOWrapper(member).read().splitlines()
+                jobs.append((parse_transfer_list(lines), ZipNewData(zip_path, members),
+                             os.path.join(outdir, name + '.img')))
+    except (zipfile.BadZipfile, Sdat2ImgError, EnvironmentError) as e:
+        print('Error: {}'.format(e), file=sys.stderr)
+        return 1
+    if not jobs:
+        print('No block based OTA partitions found in {}'.format(zip_path), file=sys.stderr)
+        return 1
+    return report_batch(jobs, workers, sparse=sparse, simg=simg, threads=threads)
+
+def report_batch(jobs, workers=None, **options):
+    """Run convert_batch() and report per-partition timings, returns the exit code."""
+    start = time.time()
+    failed = 0
+    total = 0
+    for result in convert_batch(jobs, workers, **options):
+        if result['error']:
+            failed += 1
+            print('{}: FAILED after {:.2f}s: {}'.format(result['name'], result['seconds'], result['error']))
+        else:
+            total += result['size']
+            print('{}: {} bytes in {:.2f}s'.format(result['name'], result['size'], result['seconds']))
+    print('Converted {} of {} partitions ({} bytes) in {:.2f}s'.format(
+        len(jobs) - failed, len(jobs), total, time.time() - start))
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Convert a sparse Android data image (.dat) into a filesystem image',
+                                     epilog='Visit xda thread for more information.')
+    parser.add_argument('transfer_list', nargs='?', help='transfer list file')
+    parser.add_argument('new_data', nargs='?', help='system new dat file (.br, .xz and .zst are decompressed on the fly); '
+                        'split files (system.new.dat.0..N) may be given by name or as a glob')
+    parser.add_argument('output', nargs='?', default='system.img', help='output system image (default: system.img)')
+    parser.add_argument('--sparse', action='store_true', help='leave all-zero blocks of the new data as holes')
+    parser.add_argument('--simg', action='store_true', help='write an Android sparse image instead of a raw image')
+    parser.add_argument('--base', metavar='BASE_IMG', help='base image to apply an incremental OTA on')
+    parser.add_argument('--patch', metavar='PATCH_DAT', help='patch data (system.patch.dat) of an incremental OTA')
+    parser.add_argument('--batch', nargs='+', metavar='TRANSFER_LIST',
+                        help='convert NAME.transfer.list + NAME.new.dat[.br|.xz|.zst] pairs in parallel')
+    parser.add_argument('--outdir', default='.', help='output directory of --batch and --zip (default: current directory)')
+    parser.add_argument('-j', '--jobs', type=int,
+                        help='partitions converted at the same time by --batch and --zip (default: CPU count)')
+    parser.add_argument('-t', '--threads', type=int, default=1,
+                        help='threads copying the ranges of uncompressed new data (default: 1)')
+    parser.add_argument('--resume', action='store_true',
+                        help='checkpoint progress in <output>.ckpt and continue an interrupted conversion')
+    parser.add_argument('--simg-out', metavar='SIMG', help='also write an Android sparse image, in the same pass')
+    parser.add_argument('--hash', action='append', default=[], metavar='ALGORITHM',
+                        help='hash the final raw image (e.g. sha1, sha256) while converting; may be repeated')
+    parser.add_argument('--zip', metavar='OTA_ZIP',
+                        help='convert every partition of a block based OTA zip, reading it in place')
+    parser.add_argument('--partitions', nargs='+', metavar='NAME', help='only convert these partitions with --zip')
+    args = parser.parse_args()
+
+    if args.zip:
+        sys.exit(zip_main(args.zip, args.outdir, args.jobs, sparse=args.sparse, simg=args.simg,
+                          threads=args.threads, partitions=args.partitions))
+    if args.batch:
+        sys.exit(batch_main(args.batch, args.outdir, args.jobs, sparse=args.sparse, simg=args.simg,
+                            threads=args.threads))
+    if not args.transfer_list or not args.new_data:
+        parser.error('the transfer_list and new_data arguments are required')
 
-    main(TRANSFER_LIST_FILE, NEW_DATA_FILE, OUTPUT_IMAGE_FILE)
+    main(args.transfer_list, args.new_data, args.output, sparse=args.sparse, simg=args.simg,
+         BASE_IMAGE_FILE=args.base, PATCH_DATA_FILE=args.patch, threads=args.threads, resume=args.resume,
+         SIMG_OUTPUT_FILE=args.simg_out, hashes=args.hash)
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#====================================================
+#          FILE: sdat2img_bench.py
+#   DESCRIPTION: Benchmarks sdat2img copy strategies on
+#                synthetic transfer lists
+#====================================================
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import sys, os, json, random, resource, shutil, tempfile, time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import sdat2img
+
+BLOCK_SIZE = sdat2img.BLOCK_SIZE
+
+# Size of the pieces a split new.dat is cut into
+SPLIT_PART_SIZE = 1024 * 1024 * 32
+
+# How the conversion is run, as write_image() options. 'sinks' writes a
+# raw image, a sparse image and two hashes through write_sinks() instead.
+STRATEGIES = {
+    'copy': {},
+    'threads': {'threads': 4},
+    'sparse': {'sparse': True},
+    'simg': {'simg': True},
+    'sinks': None,
+}
+
+def scenario_ranges(scenario, total_blocks, rng):
+    """Lay out |total_blocks| for a scenario, returns [(cmd, [(begin, end)])].
+
+    small: thousands of 1-8 block 'new' ranges in shuffled order
+    huge:  a few 'new' ranges covering almost the whole image
+    zero:  mostly 'zero' and 'erase', with some 'new' in between
+    split: like huge, with the new data split in several files
+    """
+    commands = []
+    if scenario == 'small':
+        pos = 0
+        ranges = []
+        while pos < total_blocks:
+            count = min(rng.randint(1, 8), total_blocks - pos)
+            ranges.append((pos, pos + count))
+            pos += count + rng.randint(0, 2)
+        rng.shuffle(ranges)
+        for i in range(0, len(ranges), 64):
+            commands.append(('new', ranges[i:i + 64]))
+    elif scenario in ('huge', 'split'):
+        step = total_blocks // 4
+        commands.append(('erase', [(0, total_blocks)]))
+        for begin in range(0, total_blocks, step):
+            end = min(begin + step - 1, total_blocks)
+            if begin < end:
+                commands.append(('new', [(begin, end)]))
+        commands.append(('zero', [(begin, begin + 1) for begin in range(step - 1, total_blocks, step)]))
+    elif scenario == 'zero':
+        pos = 0
+        while pos < total_blocks:
+            count = min(rng.randint(16, 256), total_blocks - pos)
+            cmd = rng.choice(('zero', 'zero', 'erase', 'new'))
+            commands.append((cmd, [(pos, pos + count)]))
+            pos += count
+    else:
+        raise ValueError('Unknown scenario {}'.format(scenario))
+    return commands
+
+def format_ranges(ranges):
+    values = [str(len(ranges)*2)]
+    for begin, end in ranges:
+        values += [str(begin), str(end)]
+    return ','.join(values)
+
+def write_new_data(path, blocks, rng, zero_ratio=0.1):
+    """Write |blocks| blocks of new data, |zero_ratio| of them all zeros."""
+    chunk = [os.urandom(BLOCK_SIZE) for _ in range(64)]
+    with open(path, 'wb') as f:
+        for _ in range(blocks):
+            f.write(sdat2img.ZERO_BLOCK if rng.random() < zero_ratio else rng.choice(chunk))
+
+def split_file(path):
+    """Split |path| into path.0 .. path.N, returns the parts."""
+    parts = []
+    with open(path, 'rb') as src:
+        while True:
+            data = src.read(SPLIT_PART_SIZE)
+            if not data:
+                break
+            part = '{}.{}'.format(path, len(parts))
+            with open(part, 'wb') as dst:
+                dst.write(data)
+            parts.append(part)
+    os.remove(path)
+    return parts
+
+def generate(workdir, scenario, version, size, seed=0):
+    """Generate NAME.transfer.list and its new data in |workdir| for an image
+    of |size| bytes. Returns (transfer list path, new data spec)."""
+    rng = random.Random(seed)
+    total_blocks = size // BLOCK_SIZE
+    commands = scenario_ranges(scenario, total_blocks, rng)
+    name = os.path.join(workdir, '{}-v{}'.format(scenario, version))
+    new_blocks = sum(end - begin for cmd, ranges in commands if cmd == 'new' for begin, end in ranges)
+
+    with open(name + '.transfer.list', 'w') as f:
+        f.write('{}\n{}\n'.format(version, total_blocks))
+        if version >= 2:
+            f.write('0\n0\n')
+        for cmd, ranges in commands:
+            f.write('{} {}\n'.format(cmd, format_ranges(ranges)))
+
+    new_data = name + '.new.dat'
+    write_new_data(new_data, new_blocks, rng)
+    if scenario == 'split':
+        split_file(new_data)
+    return name + '.transfer.list', new_data
+
+def proc_io():
+    """Returns the read/write syscall and byte counters of this process."""
+    counters = {}
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                key, value = line.split(':')
+                counters[key] = int(value)
+    except IOError:
+        pass
+    return counters
+
+def run_once(transfer_list, new_data, output, strategy):
+    """Convert once in this process, returns the measurements."""
+    before = proc_io()
+    start = time.time()
+    options = STRATEGIES[strategy]
+    if options is None:
+        with open(output, 'w+b') as raw, open(output + '.simg', 'wb') as simg:
+            result = sdat2img.write_sinks(transfer_list, new_data, raw=raw, simg=simg, hashes=('sha1', 'sha256'))
+        size = result['size']
+    else:
+        with open(output, 'wb') as sink:
+            size = sdat2img.write_image(transfer_list, new_data, sink, **options)
+    seconds = time.time() - start
+    after = proc_io()
+    stats = {'size': size, 'seconds': seconds,
+             # ru_maxrss is in KiB on Linux
+             'max_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}
+    for key in ('syscr', 'syscw', 'read_bytes', 'write_bytes'):
+        if key in after:
+            stats[key] = after[key] - before.get(key, 0)
+    return stats
+
+def run_isolated(transfer_list, new_data, output, strategy):
+    """run_once() in a freshly spawned process so peak RSS is its own."""
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+        return pool.submit(run_once, transfer_list, new_data, output, strategy).result()
+
+def new_data_size(new_data):
+    return sum(os.path.getsize(part) for part in sdat2img.resolve_new_data_parts(new_data))
+
+def main(scenarios, versions, strategies, size, repeat=1, workdir=None, as_json=False):
+    own_workdir = workdir is None
+    workdir = workdir or tempfile.mkdtemp(prefix='sdat2img_bench.')
+    results = []
+    try:
+        if not as_json:
+            print('{:<8} {:>2} {:<8} {:>9} {:>9} {:>9} {:>9} {:>9}'.format(
+                'scenario', 'v', 'strategy', 'seconds', 'MB/s', 'syscr', 'syscw', 'RSS MB'))
+        for scenario in scenarios:
+            for version in versions:
+                transfer_list, new_data = generate(workdir, scenario, version, size)
+                copied = new_data_size(new_data)
+                output = os.path.join(workdir, 'out.img')
+                for strategy in strategies:
+                    for _ in range(repeat):
+                        for path in (output, output + '.simg'):
+                            if os.path.exists(path):
+                                os.remove(path)
+                        stats = run_isolated(transfer_list, new_data, output, strategy)
+                        stats.update({'scenario': scenario, 'version': version, 'strategy': strategy,
+                                      'new_data': copied,
+                                      'mb_per_second': copied / stats['seconds'] / 1e6 if stats['seconds'] else 0})
+                        results.append(stats)
+                        if not as_json:
+                            print('{:<8} {:>2} {:<8} {:>9.3f} {:>9.1f} {:>9} {:>9} {:>9.1f}'.format(
+                                scenario, version, strategy, stats['seconds'], stats['mb_per_second'],
+                                stats.get('syscr', '-'), stats.get('syscw', '-'), stats['max_rss'] / 1e6))
+    finally:
+        if own_workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+    if as_json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    return results
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark sdat2img on synthetic transfer lists')
+    parser.add_argument('--scenario', nargs='+', default=['small', 'huge', 'zero', 'split'],
+                        choices=['small', 'huge', 'zero', 'split'], help='transfer list layouts (default: all)')
+    parser.add_argument('--version', nargs='+', type=int, default=[1, 2, 3, 4], choices=[1, 2, 3, 4],
+                        help='transfer list versions (default: all)')
+    parser.add_argument('--strategy', nargs='+', default=sorted(STRATEGIES), choices=sorted(STRATEGIES),
+                        help='conversion strategies (default: all)')
+    parser.add_argument('--size', type=int, default=256, help='image size in MiB (default: 256)')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per combination (default: 1)')
+    parser.add_argument('--workdir', help='keep generated files here instead of a temporary directory')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+
+    if args.workdir:
+        os.makedirs(args.workdir, exist_ok=True)
+    main(args.scenario, args.version, args.strategy, args.size * 1024 * 1024, args.repeat, args.workdir, args.json)
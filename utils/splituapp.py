@@ -8,108 +8,883 @@
 
 from __future__ import print_function
 
+import io
 import os
 import re
 import sys
+import json
+import mmap
+import fnmatch
 import string
 import struct
-from subprocess import check_output
+import errno
+import zipfile
+import binascii
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from sdat2img import CHUNK_HEADER, CHUNK_TYPE_CRC32, CHUNK_TYPE_DONT_CARE, CHUNK_TYPE_FILL, CHUNK_TYPE_RAW, \
+	SPARSE_HEADER, SPARSE_HEADER_MAGIC, Sdat2ImgError, open_zip_member, read_fully, zip_member_offset
+
+MAGIC = b'\x55\xAA\x5A\xA5'
+
+# Every byte value bit reversed. The block crcs are CRC-16/X-25, which is
+# the reflected form of the CRC-16/CCITT binascii.crc_hqx() computes in C
+REVERSED = [int('{0:08b}'.format(i)[::-1], 2) for i in range(256)]
+REFLECT = bytes(bytearray(REVERSED))
+
+# Bumped whenever the manifest layout changes
+MANIFEST_VERSION = 1
+
+# Amount of image data copied per read or kernel copy
+COPY_CHUNK = 1024 * 1024 * 8
+
+# Fixed part of an entry header, the per-block crc table follows it
+HEADER = struct.Struct('<4sLL8sLL16s16s16s16sHHH')
+
+def read_string(data):
+	try:
+		data = str(data.decode())
+		return ''.join(c for c in data if c in string.printable)
+	except:
+		return ''
+
+def parse_header(m, offset, end=None):
+	"""Parse the entry header at |offset|, None if it isn't a sane one or
+	its data would run past |end| (default: the end of |m|)."""
+	if end is None:
+		end = len(m)
+
+	if offset + HEADER.size > len(m):
+		return None
+
+	(magic, headersize, unknown, hardware, sequence, filesize, date, time,
+		filename, blank, checksum, blocksize, blank2) = HEADER.unpack_from(m, offset)
+
+	if magic != MAGIC or headersize < HEADER.size or offset + headersize + filesize > end:
+		return None
+
+	return {
+		'name': read_string(filename.rstrip(b'\0')).lower(),
+		'header_offset': offset,
+		'header_size': headersize,
+		'data_offset': offset + headersize,
+		'size': filesize,
+		'hardware_id': read_string(hardware.rstrip(b'\0')),
+		'sequence': sequence,
+		'date': read_string(date.rstrip(b'\0')),
+		'time': read_string(time.rstrip(b'\0')),
+		'header_checksum': checksum,
+		'block_size': blocksize,
+	}
+
+def scan(source, base=0, length=None):
+	"""Index the images in UPDATE.APP |source| without reading their data.
+
+	Headers are parsed straight from a memory map and the next one is
+	expected right after the 4-byte aligned end of the data. Anything else
+	(padding, garbage) is skipped with mmap.find(), accepting only 4-byte
+	aligned magic like the original reader did. The UPDATE.APP may also
+	be the |length| bytes at |base| of a bigger file, e.g. a stored zip
+	member. Returns a list of entry dicts in file order, with offsets in
+	|source| and the raw 'crcdata'.
+	"""
+	entries = []
+
+	with open(source, 'rb') as f:
+		if os.fstat(f.fileno()).st_size == 0:
+			return entries
+
+		m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		try:
+			end = len(m) if length is None else min(base + length, len(m))
+			pos = base
+			while True:
+				entry = parse_header(m, pos, end)
+
+				if entry is None:
+					pos = m.find(MAGIC, pos + 1, end)
+					while pos != -1 and (pos - base) % 4:
+						pos = m.find(MAGIC, pos + 1, end)
+
+					if pos == -1:
+						break
+
+					continue
+
+				entry['crcdata'] = m[pos + HEADER.size:entry['data_offset']]
+				entries.append(entry)
+				pos = entry['data_offset'] + entry['size']
+				pos += -(pos - base) % 4
+		finally:
+			m.close()
+
+	return entries
+
+def source_stat(source):
+	st = os.stat(source)
+	return {'size': st.st_size, 'mtime': int(st.st_mtime)}
+
+def write_manifest(source, entries, path, base=0):
+	"""Save the index of |source| as JSON, with the block crcs as numbers."""
+	manifest = {'version': MANIFEST_VERSION, 'source': os.path.basename(source), 'base': base, 'entries': []}
+	manifest.update(source_stat(source))
+
+	for entry in entries:
+		item = dict((key, value) for key, value in entry.items() if key != 'crcdata')
+		crcdata = entry['crcdata'][:len(entry['crcdata']) // 2 * 2]
+		item['block_crcs'] = list(struct.unpack('<%dH' % (len(crcdata) // 2), crcdata))
+		manifest['entries'].append(item)
+
+	tmp = path + '.tmp'
+	with open(tmp, 'w') as f:
+		json.dump(manifest, f, indent=1)
+
+	os.rename(tmp, path)
+
+def read_manifest(source, path, base=0):
+	"""Entries saved by write_manifest(), None if missing or out of date."""
+	try:
+		with open(path) as f:
+			manifest = json.load(f)
+	except (EnvironmentError, ValueError):
+		return None
+
+	stat = source_stat(source)
+	if manifest.get('version') != MANIFEST_VERSION or manifest.get('size') != stat['size'] or \
+			manifest.get('mtime') != stat['mtime'] or manifest.get('base', 0) != base:
+		return None
+
+	entries = []
+	for item in manifest['entries']:
+		entry = dict((key, value) for key, value in item.items() if key != 'block_crcs')
+		entry['crcdata'] = struct.pack('<%dH' % len(item['block_crcs']), *item['block_crcs'])
+		entries.append(entry)
+
+	return entries
+
+def index(source, manifest=None, base=0, length=None):
+	"""Index of |source| (see scan()), read from the JSON |manifest| when
+	it is up to date and otherwise scanned and saved there for the next
+	call."""
+	if manifest is None:
+		return scan(source, base, length)
+
+	entries = read_manifest(source, manifest, base)
+	if entries is None:
+		entries = scan(source, base, length)
+
+		try:
+			write_manifest(source, entries, manifest, base)
+		except EnvironmentError as e:
+			print('WARNING: could not write manifest '+manifest+': '+str(e))
+
+	return entries
+
+def chunk_crcs(data, blocksize):
+	"""CRC-16/X-25 of every |blocksize| block of the bytes |data|.
+
+	bytes.translate() and binascii.crc_hqx() hold the GIL, so this runs at
+	about 200 MB/s no matter how many threads check crcs at once."""
+	view = memoryview(data.translate(REFLECT))
+	crcs = []
+	for i in range(0, len(data) or 1, blocksize):
+		crc = binascii.crc_hqx(view[i:i + blocksize], 0xFFFF)
+		crcs.append((REVERSED[crc & 0xFF] << 8 | REVERSED[crc >> 8]) ^ 0xFFFF)
+	return crcs
+
+def block_crcs(entry):
+	"""Expected crc of every block of |entry|, None if it has no usable table."""
+	blocksize = entry['block_size']
+	if not blocksize:
+		return None
+
+	blocks = (entry['size'] + blocksize - 1) // blocksize
+	if len(entry['crcdata']) != blocks * 2:
+		return None
+
+	return struct.unpack('<%dH' % blocks, entry['crcdata'])
+
+def output_name(filename, img_files):
+	"""Name to extract |filename| under, given the |img_files| so far:
+	repeats are numbered filename_2, filename_3, ..."""
+	name = filename
+	n = 2
+	while name in img_files:
+		name = '%s_%d' % (filename, n)
+		n += 1
+
+	img_files.append(name)
+	return name
+
+def package_order(path):
+	"""Sort key putting the base UPDATE.APP before the update_sd_* and then
+	the update_data_* packages, and each group by name."""
+	name = os.path.basename(path).lower()
+	for rank, prefix in enumerate(('update.app', 'update_sd', 'update_data')):
+		if name.startswith(prefix):
+			return (rank, name)
+
+	return (3, name)
+
+class Namer(object):
+	"""Deterministic output names for the images of several packages.
+
+	Within a package repeats are numbered (boot, boot_2, boot_3, ...). An
+	image whose name an earlier package already took gets the name of its
+	own package appended instead (cust_update_sd_cust). Call package()
+	before the images of each package, in package_order().
+	"""
+	def __init__(self):
+		self.img_files = []
+		self.local = []
+		self.tag = ''
+		# Outputs the sparse pieces of this package are merged into
+		self.pieces = {}
+
+	def package(self, label):
+		self.local = []
+		self.pieces = {}
+		self.tag = re.sub(r'\W+', '_', os.path.splitext(os.path.basename(label))[0].lower())
+
+	def name(self, filename):
+		name = output_name(filename, self.local)
+		if name in self.img_files:
+			name = name+'_'+self.tag
+
+		return output_name(name, self.img_files)
+
+	def merge(self, filename):
+		"""Name of the output all sparse pieces of |filename| in this
+		package are merged into, and whether this is the first of them."""
+		if filename in self.pieces:
+			return self.pieces[filename], False
+
+		self.pieces[filename] = self.name(filename)
+		return self.pieces[filename], True
+
+def plan(entries, flist, namer=None):
+	"""Pick the entries to extract, returns [(entry, output name)]."""
+	jobs = []
+	namer = namer or Namer()
+
+	for entry in entries:
+		if not flist or entry['name'] in flist:
+			jobs.append((entry, namer.name(entry['name'])))
+
+	return jobs
+
+class CrcChecker(object):
+	"""Checks the block crcs of an entry as its data passes by in order."""
+	def __init__(self, entry, verify=True):
+		self.expected = block_crcs(entry) if verify else None
+		self.blocksize = entry['block_size']
+		self.block = 0
+
+	def chunk_size(self, chunk):
+		"""|chunk| rounded down to whole crc blocks."""
+		if self.expected is None:
+			return chunk
+
+		return max(chunk - chunk % self.blocksize, self.blocksize)
+
+	def check(self, data):
+		"""Check the next bytes |data|, returns an error message or None."""
+		if self.expected is None:
+			return None
+
+		for crc in chunk_crcs(data, self.blocksize):
+			if crc != self.expected[self.block]:
+				return 'crc value does not match at block %d' % self.block
+
+			self.block += 1
+
+		return None
+
+class EntryFile(io.RawIOBase):
+	"""Read-only, seekable view of the data of one UPDATE.APP entry.
+
+	Reads go straight to the package with os.pread() and are bounded to
+	the entry, nothing is copied out first. Wrap it in io.BufferedReader()
+	(see open_image()) when doing many small reads.
+	"""
+	def __init__(self, source, entry):
+		super(EntryFile, self).__init__()
+		self.fd = os.open(source, os.O_RDONLY)
+		self.name = entry['name']+'.img'
+		self.start = entry['data_offset']
+		self.size = entry['size']
+		self.pos = 0
+
+	def readable(self):
+		return True
+
+	def seekable(self):
+		return True
+
+	def tell(self):
+		return self.pos
+
+	def seek(self, offset, whence=os.SEEK_SET):
+		if whence == os.SEEK_CUR:
+			offset += self.pos
+		elif whence == os.SEEK_END:
+			offset += self.size
+
+		if offset < 0:
+			raise ValueError('negative seek position %d' % offset)
+
+		self.pos = offset
+		return offset
+
+	def readinto(self, b):
+		view = memoryview(b).cast('B')
+		n = min(len(view), self.size - self.pos)
+		if n <= 0:
+			return 0
+
+		if hasattr(os, 'preadv'):
+			n = os.preadv(self.fd, [view[:n]], self.start + self.pos)
+		else:
+			data = os.pread(self.fd, n, self.start + self.pos)
+			n = len(data)
+			view[:n] = data
+
+		self.pos += n
+		return n
+
+	def close(self):
+		if not self.closed:
+			os.close(self.fd)
+
+		super(EntryFile, self).close()
+
+def open_image(source, name, manifest=None, buffer_size=COPY_CHUNK):
+	"""Open img file |name| (as extract() would name it, e.g. super or
+	boot_2) of UPDATE.APP |source| for reading in place."""
+	for entry, filename in plan(index(source, manifest), None):
+		if filename == name:
+			return io.BufferedReader(EntryFile(source, entry), buffer_size)
+
+	raise IOError(errno.ENOENT, 'No such img file in '+source, name)
+
+def copy_entry(fd, entry, path, verify=True, unsparse=False, mode='wb'):
+	"""Copy the data of |entry| from the open UPDATE.APP |fd| to |path|.
+
+	With a crc table to check the data goes through os.pread() in large
+	chunks, otherwise os.copy_file_range() copies it in the kernel where
+	available. With |unsparse| an Android sparse image is written out raw
+	(see SparseWriter), |path| is opened with |mode|. Returns an error
+	message or None.
+
+	Checking crcs is CPU bound under the GIL (see chunk_crcs()), several
+	threads only overlap it with the I/O. Copies run at device speed in
+	parallel without verification.
+	"""
+	checker = CrcChecker(entry, verify)
+	chunk = checker.chunk_size(COPY_CHUNK)
+	writer = None
+	offset = 0
+
+	with open(path, mode) as o:
+		out = o.fileno()
+		if unsparse and is_sparse(fd, entry):
+			writer = SparseWriter(out)
+
+		kernel_copy = checker.expected is None and writer is None and hasattr(os, 'copy_file_range')
+		while offset < entry['size']:
+			n = min(chunk, entry['size'] - offset)
+
+			if kernel_copy:
+				try:
+					copied = os.copy_file_range(fd, out, n, entry['data_offset'] + offset, offset)
+				except OSError:
+					kernel_copy = False
+					continue
+
+				if not copied:
+					return 'unexpected end of file'
+
+				offset += copied
+				continue
+
+			data = os.pread(fd, n, entry['data_offset'] + offset)
+			if not data:
+				return 'unexpected end of file'
+
+			if writer is not None:
+				try:
+					writer.feed(data)
+				except ValueError as e:
+					return str(e)
+			else:
+				written = 0
+				while written < len(data):
+					written += os.pwrite(out, data[written:], offset + written)
+
+			error = checker.check(data)
+			if error:
+				return error
+
+			offset += len(data)
+
+	if writer is not None and not writer.done:
+		return 'sparse image is truncated'
+
+	return None
+
+# First bytes of a sparse image, sdat2img has the rest of the format
+SPARSE_MAGIC = struct.pack('<I', SPARSE_HEADER_MAGIC)
+
+# Entries which are pieces of one sparse super image, merged into super.img
+SUPER_PIECE = re.compile(r'^super(_\d+)?$')
+
+class SparseWriter(object):
+	"""Writes the raw image of an Android sparse image fed to it in order.
+
+	RAW and non-zero FILL chunks are written at their offset in |fd|,
+	DONT_CARE and zero FILL chunks are left as holes, so several pieces of
+	one image can be written into the same file. Raises ValueError on a
+	malformed image.
+	"""
+	def __init__(self, fd):
+		self.fd = fd
+		self.header = b''
+		self.need = SPARSE_HEADER.size
+		self.state = 'file'
+		self.skip = 0
+		self.raw = 0
+		self.fill = 0
+		self.offset = 0
+		self.chunks = None
+		self.block_size = 0
+		self.chunk_header_size = 0
+
+	@property
+	def done(self):
+		return self.chunks == 0 and self.state == 'chunk' and not self.raw and not self.skip
+
+	def feed(self, data):
+		view = memoryview(data)
+		pos = 0
+		while pos < len(view) and not self.done:
+			# The rest of a longer chunk header comes before its data
+			if self.skip:
+				n = min(self.skip, len(view) - pos)
+				self.skip -= n
+				pos += n
+			elif self.raw:
+				n = min(self.raw, len(view) - pos)
+				n = os.pwrite(self.fd, view[pos:pos + n], self.offset)
+				self.offset += n
+				self.raw -= n
+				pos += n
+			else:
+				n = min(self.need - len(self.header), len(view) - pos)
+				self.header += view[pos:pos + n].tobytes()
+				pos += n
+
+				if len(self.header) == self.need:
+					header = self.header
+					self.header = b''
+					self.parse(header)
+
+	def parse(self, header):
+		if self.state == 'file':
+			magic, major, minor, file_header_size, self.chunk_header_size, self.block_size, \
+				total_blocks, self.chunks, checksum = SPARSE_HEADER.unpack(header)
+			if header[:4] != SPARSE_MAGIC or major != 1 or self.chunk_header_size < CHUNK_HEADER.size:
+				raise ValueError('bad sparse header')
+
+			self.skip = file_header_size - SPARSE_HEADER.size
+			# The raw image keeps its full size even when it ends in holes
+			size = total_blocks * self.block_size
+			if os.fstat(self.fd).st_size < size:
+				os.ftruncate(self.fd, size)
+
+			self.state = 'chunk'
+			self.need = CHUNK_HEADER.size
+		elif self.state == 'chunk':
+			chunk_type, reserved, blocks, total_size = CHUNK_HEADER.unpack(header)
+			self.skip = self.chunk_header_size - CHUNK_HEADER.size
+			self.chunks -= 1
+			length = blocks * self.block_size
+
+			if chunk_type == CHUNK_TYPE_RAW:
+				self.raw = length
+			elif chunk_type == CHUNK_TYPE_FILL:
+				self.fill = length
+				self.state = 'fill'
+				self.need = 4
+			elif chunk_type == CHUNK_TYPE_DONT_CARE:
+				self.offset += length
+			elif chunk_type == CHUNK_TYPE_CRC32:
+				self.skip += 4
+			else:
+				raise ValueError('unknown sparse chunk type 0x%04X' % chunk_type)
+		else:
+			if header == b'\0\0\0\0':
+				self.offset += self.fill
+			else:
+				pattern = header * (min(self.fill, COPY_CHUNK) // 4)
+				end = self.offset + self.fill
+				while self.offset < end:
+					self.offset += os.pwrite(self.fd, pattern[:end - self.offset], self.offset)
+
+			self.state = 'chunk'
+			self.need = CHUNK_HEADER.size
+
+def is_sparse(fd, entry):
+	return entry['size'] >= 4 and os.pread(fd, 4, entry['data_offset']) == SPARSE_MAGIC
+
+def zip_members(source, pattern):
+	"""Members of the zip |source| matching |pattern|: a full name, or a
+	base name (glob) like UPDATE.APP or update_*.APP. Only a glob may
+	match nothing."""
+	with zipfile.ZipFile(source) as z:
+		infos = [info for info in z.infolist() if info.filename == pattern] or \
+			[info for info in z.infolist() if fnmatch.fnmatchcase(info.filename.rsplit('/', 1)[-1], pattern)]
+
+	if not infos and not re.search(r'[*?[]', pattern):
+		raise IOError(errno.ENOENT, 'No such member in '+source, pattern)
+
+	return infos
+
+def zip_member(source, member, info=None):
+	"""Find |member| (see zip_members(), the first match counts) in the zip
+	|source|. Returns its ZipInfo and the offset of its data."""
+	infos = [info] if info else zip_members(source, member)
+	if not infos:
+		raise IOError(errno.ENOENT, 'No such member in '+source, member)
+
+	info = infos[0]
+	try:
+		return info, zip_member_offset(source, info)
+	except Sdat2ImgError as e:
+		raise IOError(errno.EINVAL, str(e), source)
+
+def extract_stream(stream, flist, verify=True, listing=None, unsparse=False, namer=None):
+	"""Extract the img files from UPDATE.APP data read from the forward-only
+	|stream|, e.g. a deflated zip member.
+
+	Headers are parsed as they come by, images not in |flist| are read into
+	one reusable buffer and dropped, nothing is seeked. With a |listing|
+	list the entries are only appended to it. |unsparse| works like in
+	extract(), a shared |namer| keeps names unique across packages.
+	Returns the failure count.
+	"""
+	outdir = 'output'
+	buf = bytearray(COPY_CHUNK)
+	view = memoryview(buf)
+	namer = namer or Namer()
+	failed = 0
+	pos = 0
+
+	def skip(length):
+		while length > 0:
+			n = read_fully(stream, view[:min(length, len(view))])
+			if not n:
+				return False
+
+			length -= n
+
+		return True
+
+	while True:
+		if not skip(-pos % 4):
+			break
+
+		pos += -pos % 4
+		if read_fully(stream, view[:4]) < 4:
+			break
+
+		pos += 4
+		if view[:4] != MAGIC:
+			continue
+
+		start = pos - 4
+		n = read_fully(stream, view[4:HEADER.size])
+		pos += n
+		entry = parse_header(buf, 0, float('inf'))
+		if n < HEADER.size - 4 or entry is None:
+			continue
+
+		crclen = entry['header_size'] - HEADER.size
+		entry['crcdata'] = stream.read(crclen)
+		if len(entry['crcdata']) < crclen:
+			break
+
+		entry['header_offset'] = start
+		entry['data_offset'] = start + entry['header_size']
+		pos = entry['data_offset'] + entry['size']
+
+		if listing is not None or (flist and entry['name'] not in flist):
+			if listing is not None:
+				listing.append(entry)
+
+			if not skip(entry['size']):
+				break
+
+			continue
+
+		checker = CrcChecker(entry, verify)
+		chunk = checker.chunk_size(len(buf))
+		left = entry['size']
+		error = None
+
+		# The first chunk tells whether this is a sparse image
+		n = read_fully(stream, view[:min(chunk, left)])
+		sparse = unsparse and n >= 4 and view[:4] == SPARSE_MAGIC
+		mode = 'wb'
+		if sparse and SUPER_PIECE.match(entry['name']):
+			filename, first = namer.merge('super')
+			if not first:
+				mode = 'r+b'
+		else:
+			filename = namer.name(entry['name'])
+
+		print('Extracting '+filename+'.img '+('(unsparsing) ' if sparse else '')+'...')
 
-def extract(source, flist):
-	def cmd(command):
 		try:
-			test1 = check_output(command)
-			test1 = test1.strip().decode()
-		except:
-			test1 = ''
+			with open(outdir+os.sep+filename+'.img', mode) as o:
+				writer = SparseWriter(o.fileno()) if sparse else None
+				while left > 0:
+					if not n:
+						n = read_fully(stream, view[:min(chunk, left)])
+
+					if not n:
+						error = 'unexpected end of file'
+						break
+
+					left -= n
+					if writer is not None:
+						writer.feed(view[:n])
+					else:
+						o.write(view[:n])
+
+					error = checker.check(bytes(view[:n]))
+					n = 0
+					if error:
+						break
 
-		return test1
+				if not error and writer is not None and not writer.done:
+					error = 'sparse image is truncated'
+		except EnvironmentError as e:
+			error = 'failed to create it: %s' % e
+		except ValueError as e:
+			error = str(e)
+
+		if error:
+			print('ERROR: '+filename+'.img: '+error+'\n')
+			failed += 1
+		elif verify and checker.expected is None and entry['crcdata']:
+			print('WARNING: no usable crc table for '+filename+'.img, not verified\n')
+
+		# Stay in step with the stream after a failed image
+		if left > 0 and not skip(left):
+			break
+
+	return failed
+
+def open_stream(source):
+	"""Open a forward-only UPDATE.APP |source|: '-' for stdin, an http(s)
+	URL, or any path such as a named pipe."""
+	if source == '-':
+		return io.open(sys.stdin.fileno(), 'rb', closefd=False)
+
+	if re.match(r'https?://', source):
+		try:
+			from urllib.request import urlopen
+		except ImportError:
+			from urllib2 import urlopen
+
+		return io.BufferedReader(urlopen(source), COPY_CHUNK)
+
+	return io.open(source, 'rb')
+
+def is_stream(source):
+	"""Whether |source| can only be read front to back."""
+	if source == '-' or re.match(r'https?://', source):
+		return True
+
+	try:
+		return not os.path.isfile(source)
+	except EnvironmentError:
+		return False
+
+def packages(sources, members=None):
+	"""Resolve the UPDATE.APP |sources| into packages, in package_order().
+
+	With |members| (patterns, see zip_members()) the single source is a
+	zip and every matching member is a package. Each package is a dict
+	with its 'label', the 'path' it is read from, its zip 'info' if any,
+	the 'base' and 'length' of a stored member in the zip, and 'stream'
+	set when it can only be read front to back.
+	"""
+	found = []
+
+	if members:
+		if len(sources) != 1:
+			raise IOError(errno.EINVAL, 'Members can only be read out of one zip', ' '.join(sources))
+
+		source = sources[0]
+		seen = []
+		for pattern in members:
+			for info in zip_members(source, pattern):
+				if info.filename in seen:
+					continue
+
+				seen.append(info.filename)
+				info, base = zip_member(source, info.filename, info)
+				found.append({'label': info.filename, 'path': source, 'info': info, 'base': base,
+					'length': info.file_size, 'stream': info.compress_type != zipfile.ZIP_STORED})
+
+		if not found:
+			raise IOError(errno.ENOENT, 'No such member in '+source, ' '.join(members))
+	else:
+		for source in sources:
+			found.append({'label': source, 'path': source, 'info': None, 'base': 0, 'length': None,
+				'stream': is_stream(source)})
+
+	return sorted(found, key=lambda package: package_order(package['label']))
+
+def open_package_stream(package):
+	if package['info'] is None:
+		return open_stream(package['path'])
+
+	return open_zip_member(package['path'], package['info'])
+
+def package_manifest(package, manifest):
+	"""Manifest path of |package|: |manifest| itself, or with True the
+	default next to the package (<update.app>.json)."""
+	if manifest is not True:
+		return manifest
+
+	if package['info'] is None:
+		return package['path']+'.json'
+
+	return package['path']+'.'+os.path.basename(package['label'])+'.json'
+
+def package_entries(package, manifest=None):
+	"""Index of one package, streams are read through once to list them."""
+	if package['stream']:
+		listing = []
+		with open_package_stream(package) as stream:
+			extract_stream(stream, None, listing=listing)
+
+		return listing
+
+	return index(package['path'], package_manifest(package, manifest), package['base'], package['length'])
+
+def package_index(sources, manifest=None, members=None):
+	"""Index all packages of |sources| (see packages()) in parallel.
+	Returns [(package, entries)] in package_order()."""
+	return index_packages(packages(sources, members), manifest)
+
+def index_packages(found, manifest=None):
+	from concurrent.futures import ThreadPoolExecutor
+
+	if len(found) > 1 and manifest not in (None, True):
+		raise IOError(errno.EINVAL, 'One manifest can\'t index several packages, use -m without a path', manifest)
+
+	with ThreadPoolExecutor(max_workers=len(found) or 1) as pool:
+		return list(zip(found, pool.map(lambda package: package_entries(package, manifest), found)))
+
+def extract(sources, flist, threads=None, verify=True, manifest=None, members=None, unsparse=False):
+	"""Extract the img files of the UPDATE.APP |sources| (all, or those in
+	|flist|) into output/, copying up to |threads| images at the same time.
+
+	Several packages (UPDATE.APP, update_sd_*.APP, update_data_*.APP) are
+	indexed in parallel and extracted through one worker pool, with the
+	names made unique by Namer. The index comes from |manifest| when given,
+	see index(); True uses the default path per package. With |members|
+	the source is a zip and the packages are read out of it in place when
+	stored, or decompressed as a stream when deflated. Sources which can't
+	seek (stdin as '-', URLs, pipes) are extracted as a stream too. With
+	|unsparse| Android sparse images are written out raw as they are
+	extracted, and the sparse pieces of super are merged into super.img.
+	"""
+	from concurrent.futures import ThreadPoolExecutor
+
+	if isinstance(sources, str):
+		sources = [sources]
+
+	if isinstance(members, str):
+		members = [members]
 
-	bytenum = 4
 	outdir = 'output'
-	img_files = []
 
 	try:
 		os.makedirs(outdir)
 	except:
 		pass
 
-	py2 = None
-	if int(''.join(str(i) for i in sys.version_info[0:2])) < 30:
-		py2 = 1
+	found = packages(sources, members)
+	seekable = [package for package in found if not package['stream']]
+	if len(found) > 1 and manifest not in (None, True):
+		raise IOError(errno.EINVAL, 'One manifest can\'t index several packages, use -m without a path', manifest)
 
-	with open(source, 'rb') as f:
-		while True:
-			i = f.read(bytenum)
+	indexed = dict((package['label'], entries) for package, entries in index_packages(seekable, manifest))
 
-			if not i:
-				break
-			elif i != b'\x55\xAA\x5A\xA5':
-				continue
+	namer = Namer()
+	failed = 0
+	fds = {}
+	tasks = []
+
+	try:
+		for package in found:
+			namer.package(package['label'])
 
-			headersize = f.read(bytenum)
-			headersize = list(struct.unpack('<L', headersize))[0]
-			f.seek(16, 1)
-			filesize = f.read(bytenum)
-			filesize = list(struct.unpack('<L', filesize))[0]
-			f.seek(32, 1)
-			filename = f.read(16)
+			if package['stream']:
+				with open_package_stream(package) as stream:
+					failed += extract_stream(stream, flist, verify, unsparse=unsparse, namer=namer)
 
-			try:
-				filename = str(filename.decode())
-				filename = ''.join(f for f in filename if f in string.printable).lower()
-			except:
-				filename = ''
+				continue
+
+			if package['path'] not in fds:
+				fds[package['path']] = os.open(package['path'], os.O_RDONLY)
 
-			f.seek(22, 1)
-			crcdata = f.read(headersize - 98)
+			fd = fds[package['path']]
+			for entry in indexed[package['label']]:
+				if flist and entry['name'] not in flist:
+					continue
 
-			if not flist or filename in flist:
-				if filename in img_files:
-					filename = filename+'_2'
+				mode = 'wb'
+				sparse = unsparse and is_sparse(fd, entry)
+				if sparse and SUPER_PIECE.match(entry['name']):
+					# All pieces write into one file, created before any of them runs
+					filename, first = namer.merge('super')
+					mode = 'r+b'
+					if first:
+						open(outdir+os.sep+filename+'.img', 'wb').close()
+				else:
+					filename = namer.name(entry['name'])
 
-				print('Extracting '+filename+'.img ...')
+				tasks.append((fd, entry, filename, mode, sparse))
 
-				chunk = 10240
+		with ThreadPoolExecutor(max_workers=threads) as pool:
+			futures = []
+			for fd, entry, filename, mode, sparse in tasks:
+				print('Extracting '+filename+'.img '+('(unsparsing) ' if sparse else '')+'...')
+				futures.append(pool.submit(copy_entry, fd, entry, outdir+os.sep+filename+'.img', verify,
+					unsparse, mode))
 
+			for (fd, entry, filename, mode, sparse), future in zip(tasks, futures):
 				try:
-					with open(outdir+os.sep+filename+'.img', 'wb') as o:
-						while filesize > 0:
-							if chunk > filesize:
-								chunk = filesize
-
-							o.write(f.read(chunk))
-							filesize -= chunk
-				except:
-					print('ERROR: Failed to create '+filename+'.img\n')
-					return 1
-
-				img_files.append(filename)
-
-				if os.name != 'nt':
-					if os.path.isfile('crc'):
-						print('Calculating crc value for '+filename+'.img ...\n')
-
-						crcval = []
-						if py2:
-							for i in crcdata:
-								crcval.append('%02X' % ord(i))
-						else:
-							for i in crcdata:
-								crcval.append('%02X' % i)
-
-						crcval = ''.join(crcval)
-						crcact = cmd('./crc output/'+filename+'.img')
-
-						if crcval != crcact:
-							print('ERROR: crc value for '+filename+'.img does not match\n')
-							return 1
-			else:
-				f.seek(filesize, 1)
+					error = future.result()
+				except EnvironmentError as e:
+					error = 'failed to create it: %s' % e
 
-			xbytes = bytenum - f.tell() % bytenum
-			if xbytes < bytenum:
-				f.seek(xbytes, 1)
+				if error:
+					print('ERROR: '+filename+'.img: '+error+'\n')
+					failed += 1
+				elif verify and block_crcs(entry) is None and entry['crcdata']:
+					print('WARNING: no usable crc table for '+filename+'.img, not verified\n')
+	finally:
+		for fd in fds.values():
+			os.close(fd)
+
+	if failed:
+		return 1
 
 	print('\nExtraction complete')
 	return 0
@@ -119,10 +894,38 @@ if __name__ == '__main__':
 
 	parser = argparse.ArgumentParser(description="Split UPDATE.APP file into img files", add_help=False)
 	required = parser.add_argument_group('Required')
-	required.add_argument("-f", "--filename", required=True, help="Path to update.app file")
+	required.add_argument("-f", "--filename", required=True, nargs="+",
+		help="Path to update.app file (- for stdin, or an http(s) URL); several packages (update_sd_*.app, ...) may be given")
 	optional = parser.add_argument_group('Optional')
 	optional.add_argument("-h", "--help", action="help", help="show this help message and exit")
 	optional.add_argument("-l", "--list", nargs="*", metavar=('img1', 'img2'), help="List of img files to extract")
+	optional.add_argument("-i", "--info", action="store_true", help="List the img files in update.app without extracting")
+	optional.add_argument("-t", "--threads", type=int, help="Number of img files extracted at the same time (crc checks don't run in parallel, see -n)")
+	optional.add_argument("-n", "--no-crc", action="store_true", help="Skip crc verification, allows kernel copies at full device speed")
+	optional.add_argument("-m", "--manifest", nargs="?", const='', metavar='JSON',
+		help="Reuse or write the index of update.app as JSON (default: <update.app>.json)")
+	optional.add_argument("-z", "--member", nargs="+", metavar='UPDATE.APP',
+		help="Read these update.app packages (names or globs) out of the firmware zip given with -f, without unpacking it")
+	optional.add_argument("-r", "--raw", action="store_true",
+		help="Write sparse images out raw while extracting, merging the super pieces into super.img")
 	args = parser.parse_args()
 
-	extract(args.filename, args.list)
+	manifest = args.manifest
+	if manifest == '':
+		manifest = True
+
+	try:
+		if args.info:
+			indexed = package_index(args.filename, manifest, args.member)
+			for package, entries in indexed:
+				if len(indexed) > 1:
+					print('== '+package['label'])
+
+				for entry in entries:
+					print('%-24s offset %-12d size %d' % (entry['name']+'.img', entry['data_offset'], entry['size']))
+			sys.exit(0)
+
+		sys.exit(extract(args.filename, args.list, args.threads, not args.no_crc, manifest, args.member, args.raw))
+	except (EnvironmentError, zipfile.BadZipfile) as e:
+		print('ERROR: '+str(e))
+		sys.exit(1)